@@ -1,21 +1,45 @@
 import os
 import logging
+import argparse
+import multiprocessing
+import socket
 import sqlite3
-import requests
 import html
 import asyncio
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import json
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+import aiohttp
 import yt_dlp
+from aiohttp import web
+from collections import OrderedDict, Counter, deque
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from aiogram.enums import ParseMode
 from aiogram.utils import markdown
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, \
-    CallbackQuery
+    CallbackQuery, InputMediaAudio
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
-from vkpymusic import Service
 
 
 
@@ -34,109 +58,1107 @@ dev_contact_message = "Пожалуйста, отправьте описание
 MAX_TELEGRAM_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2ГБ
 TELEGRAM_MAX_FILE_SIZE = 50 * 1024 * 1024  # 50МБ
 
+# Адрес своего сервера telegram-bot-api (например http://localhost:8081).
+# С ним файлы до 2ГБ отправляются по локальному пути, без загрузки через multipart
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+# Количество потоков для yt-dlp и других блокирующих загрузок
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+
+# Отдельные потоки для извлечения метаданных и поиска YouTube: они не ждут за долгими загрузками
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+
+# Планировщик загрузок: общий лимит одновременных загрузок и лимиты по платформам ("YouTube=2,TikTok=3")
+SCHEDULER_LIMIT = int(os.getenv("SCHEDULER_LIMIT", str(DOWNLOAD_WORKERS)))
+SCHEDULER_PLATFORM_LIMITS = {
+    platform.strip(): int(limit)
+    for platform, limit in (item.split("=") for item in os.getenv("SCHEDULER_PLATFORM_LIMITS", "").split(",") if item)
+}
+
+# Время жизни и размер кэша info_dict (ссылки на потоки YouTube живут несколько часов)
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "1800"))
+INFO_CACHE_SIZE = int(os.getenv("INFO_CACHE_SIZE", "256"))
+
+# Время жизни и размер кэша раскрытых коротких ссылок (vt.tiktok.com)
+SHORT_LINK_CACHE_TTL = int(os.getenv("SHORT_LINK_CACHE_TTL", "86400"))
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "4096"))
+
+# Папка, в которой создаются временные каталоги задач
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR") or tempfile.gettempdir()
+
+# Кэш готовых файлов на диске: папка и квота в байтах (0 выключает кэш)
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "../media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(5 * 1024 * 1024 * 1024)))
+
+# Сколько ссылок одного пользователя из пакета скачивается одновременно
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "3"))
+
+# VK API: адрес методов и версия, с которой audio.search отдает ссылки на mp3
+VK_API_URL = "https://api.vk.com/method"
+VK_MUSIC_API_VERSION = "5.131"
+
+# Заголовки для yt-dlp на VK: и метаданные, и загрузка извлекаются с ними, чтобы делить один info_dict
+VK_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Referer': 'https://vk.com/',
+}
+
+# ffmpeg-обработка (перепаковка, извлечение звука): путь к бинарнику и число воркеров.
+# Пул обработки не зависит от DOWNLOAD_WORKERS: сеть и CPU масштабируются отдельно
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(os.cpu_count() or 2)))
+
+# Прямые HTTP-загрузки: размер куска, который держится в памяти, и таймауты
+HTTP_CHUNK_SIZE = 64 * 1024
+HTTP_CONNECT_TIMEOUT = int(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = int(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# Кэш результатов поиска VK музыки и размер одной порции результатов
+VK_SEARCH_CACHE_TTL = int(os.getenv("VK_SEARCH_CACHE_TTL", "900"))
+VK_SEARCH_CACHE_SIZE = int(os.getenv("VK_SEARCH_CACHE_SIZE", "512"))
+VK_SEARCH_BATCH = 50
+MUSIC_PAGE_SIZE = 5
+# Сколько треков одного пользователя скачивается одновременно при загрузке целой страницы
+MUSIC_CONCURRENCY = int(os.getenv("MUSIC_CONCURRENCY", "3"))
+
+# Общий пул HTTP-соединений
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_USER_AGENT = os.getenv(
+    "HTTP_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36")
+
+# База данных: путь и параметры группового коммита
+DB_PATH = os.getenv("DB_PATH", "../telegram_bot.db")
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "500"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.05"))
+# Сколько раз задача загрузки запускается заново после перезапусков бота
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Хранилище состояний FSM: sqlite (переживает перезапуск) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "../fsm_storage.db")
+FSM_SHARDS = int(os.getenv("FSM_SHARDS", "1"))
+FSM_TTL = int(os.getenv("FSM_TTL", str(7 * 24 * 3600)))  # неделя без активности
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Webhook: публичный адрес (например https://bot.example.com), путь, адрес локального сервера и секрет
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Сколько процессов обрабатывают апдейты в режиме webhook
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+
+# Где выполняются загрузки: local (в процессе бота) или broker (процессы --mode worker берут задачи из таблицы jobs)
+DOWNLOAD_BACKEND = os.getenv("DOWNLOAD_BACKEND", "local")
+# Брокер: период опроса таблицы jobs, срок аренды задачи воркером (сек.) и сколько задач воркер берет одновременно
+BROKER_POLL_INTERVAL = float(os.getenv("BROKER_POLL_INTERVAL", "0.5"))
+BROKER_LEASE = int(os.getenv("BROKER_LEASE", "120"))
+BROKER_WORKER_JOBS = int(os.getenv("BROKER_WORKER_JOBS", str(DOWNLOAD_WORKERS)))
+
+# Эндпоинт /metrics в формате Prometheus (METRICS_PORT=0 выключает его)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9200"))
+
+# Контроль задержек: период замера event loop, порог задержки и порог медленного обработчика (сек.)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+SLOW_HANDLER_THRESHOLD = float(os.getenv("SLOW_HANDLER_THRESHOLD", "5"))
+
+
+# --- МЕТРИКИ ---
+# Платформа текущей задачи: стадии, которые не знают ссылку (ffmpeg, загрузка в Telegram), берут ее отсюда
+current_platform = contextvars.ContextVar("current_platform", default="other")
+# id записи в таблице jobs для текущей загрузки, по нему стадии отмечают ее состояние
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы в текстовом формате Prometheus.
+    Все обновления идут из event loop, поэтому блокировки не нужны
+    """
+
+    # Границы корзин гистограмм длительности, в секундах
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._runner = None
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+        for idx, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][idx] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def gauge(self, name, func, help_text=""):
+        """Регистрирует значение, которое вычисляется в момент запроса /metrics"""
+        self._gauges[name] = func
+        self._help[name] = help_text
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    @contextlib.contextmanager
+    def timer(self, stage, platform=None):
+        """Замеряет длительность стадии, ошибки стадии попадают в bot_errors_total"""
+        platform = platform or current_platform.get()
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("bot_errors_total", stage=stage, platform=platform)
+            raise
+        finally:
+            self.observe("bot_stage_duration_seconds", time.perf_counter() - started, stage=stage, platform=platform)
+
+    def cache(self, name, hit):
+        self.inc("bot_cache_requests_total", cache=name, result="hit" if hit else "miss")
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _format(cls, name, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return name
+        body = ",".join(f'{key}="{cls._escape(value)}"' for key, value in pairs)
+        return f"{name}{{{body}}}"
+
+    def render(self):
+        lines = []
+
+        def header(name, kind):
+            if self._help.get(name):
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted({name for name, _ in self._counters}):
+            header(name, "counter")
+            for (metric, labels), value in sorted(self._counters.items()):
+                if metric == name:
+                    lines.append(f"{self._format(name, labels)} {value}")
+
+        for name in sorted({name for name, _ in self._histograms}):
+            header(name, "histogram")
+            for (metric, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    lines.append(f"{self._format(name + '_bucket', labels, [('le', bound)])} {bucket}")
+                lines.append(f"{self._format(name + '_bucket', labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{self._format(name + '_sum', labels)} {total}")
+                lines.append(f"{self._format(name + '_count', labels)} {count}")
+
+        for name, func in sorted(self._gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def start_server(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Поднимает HTTP-сервер с /metrics в текущем event loop"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+            logging.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+        except OSError as e:
+            logging.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+            await self.close()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Инициализация метрик
+metrics = Metrics()
+metrics.describe("bot_stage_duration_seconds",
+                 "Длительность стадий: extract, download, postprocess, upload, db_write")
+metrics.describe("bot_bytes_total", "Байты, скачанные из источников и загруженные в Telegram")
+metrics.describe("bot_errors_total", "Ошибки по стадиям")
+metrics.describe("bot_cache_requests_total", "Обращения к кэшам: file_id, info, vk_search, inflight")
+
+
+# --- КОНТРОЛЬ ЗАДЕРЖЕК EVENT LOOP ---
+class LoopWatchdog:
+    """
+    Замеряет задержку event loop. Корутина-пульс засыпает на interval и смотрит, насколько опоздала,
+    а отдельный поток следит за пульсом: если loop заблокирован дольше threshold,
+    он снимает стек потока event loop, чтобы было видно, какой синхронный вызов его держит
+    :param interval: Период пульса в секундах
+    :param threshold: Задержка, после которой пишется предупреждение
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._loop = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._last_beat = time.monotonic()
+            self.lag = max(0.0, self._last_beat - started - self.interval)
+            metrics.observe("bot_loop_lag_seconds", self.lag)
+            if self.lag > self.threshold:
+                logging.warning(f"⚠️ Event loop отстал на {self.lag:.3f} с")
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._last_beat
+            stalled = time.monotonic() - beat - self.interval
+            # Об одной блокировке сообщаем один раз
+            if stalled <= self.threshold or reported == beat:
+                continue
+            reported = beat
+            # Metrics обновляется только из event loop: счетчик увеличится, когда loop освободится
+            with contextlib.suppress(RuntimeError):
+                self._loop.call_soon_threadsafe(metrics.inc, "bot_loop_stalls_total")
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен\n"
+            logging.warning(f"🐢 Event loop заблокирован уже {stalled:.2f} с. Стек потока event loop:\n{stack}")
+
+    def start(self):
+        """Запускает пульс в текущем event loop и поток-наблюдатель"""
+        self._loop_thread_id = threading.get_ident()
+        self._loop = asyncio.get_running_loop()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+
+def coroutine_stack(coro):
+    """Цепочка await от корневой корутины задачи до места, где она сейчас ждет"""
+    lines = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        lines.append(f'  File "{frame.f_code.co_filename}", line {frame.f_lineno}, in {frame.f_code.co_name}')
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return "\n".join(lines)
+
+
+class SlowHandlerMiddleware(BaseMiddleware):
+    """
+    Замеряет время обработчиков aiogram. Если обработчик работает дольше threshold,
+    пишет его имя, тип апдейта и стек места, где он сейчас ждет
+    :param threshold: Порог в секундах
+    """
+
+    def __init__(self, threshold=SLOW_HANDLER_THRESHOLD):
+        self.threshold = threshold
+
+    @staticmethod
+    def _report(name, update_type, task, threshold):
+        stack = coroutine_stack(task.get_coro()) if task and not task.done() else "стек недоступен"
+        logging.warning(f"🐢 Обработчик {name} ({update_type}) работает дольше {threshold:.1f} с. "
+                        f"Сейчас ждет здесь:\n{stack}")
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        update = data.get("event_update")
+        update_type = update.event_type if update else type(event).__name__
+
+        # Если обработчик блокирует loop, таймер не сработает вовремя — такие случаи ловит LoopWatchdog
+        timer = asyncio.get_running_loop().call_later(
+            self.threshold, self._report, name, update_type, asyncio.current_task(), self.threshold)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_handler_duration_seconds", elapsed, handler=name, update_type=update_type)
+            if elapsed > self.threshold:
+                metrics.inc("bot_slow_handlers_total", handler=name, update_type=update_type)
+                logging.warning(f"🐢 Обработчик {name} ({update_type}) выполнялся {elapsed:.2f} с")
+
+
+# Инициализация контроля задержек
+loop_watchdog = LoopWatchdog()
+metrics.describe("bot_loop_lag_seconds", "Опоздание пульса event loop")
+metrics.describe("bot_loop_stalls_total", "Блокировки event loop дольше LOOP_LAG_THRESHOLD")
+metrics.describe("bot_handler_duration_seconds", "Время работы обработчиков aiogram")
+metrics.describe("bot_slow_handlers_total", "Обработчики дольше SLOW_HANDLER_THRESHOLD")
+
+
+# --- ХРАНИЛИЩЕ СОСТОЯНИЙ FSM ---
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite с вытеснением по TTL.
+    Записи раскладываются по шардам (отдельным файлам) по user_id, файлы работают в режиме WAL,
+    поэтому несколько процессов бота могут делить одно состояние, и оно переживает перезапуск
+    :param path: Путь к файлу базы. При shards > 1 к имени добавляется номер шарда
+    :param shards: Количество шардов
+    :param ttl: Через сколько секунд без изменений запись удаляется
+    """
+
+    CLEANUP_INTERVAL = 600
+
+    def __init__(self, path, shards=1, ttl=FSM_TTL):
+        root, ext = os.path.splitext(path)
+        self.paths = [path] if shards == 1 else [f"{root}_{i}{ext}" for i in range(shards)]
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._connections = [None] * len(self.paths)
+        # На каждый шард свой поток, чтобы соединение использовалось только из него
+        self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"fsm{i}")
+                           for i in range(len(self.paths))]
+        self._last_cleanup = [0.0] * len(self.paths)
+
+    def _shard(self, key: StorageKey):
+        return key.user_id % len(self.paths)
+
+    def _connection(self, shard):
+        if self._connections[shard] is None:
+            conn = sqlite3.connect(self.paths[shard])
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS fsm_expires ON fsm (expires_at)")
+            conn.commit()
+            self._connections[shard] = conn
+        return self._connections[shard]
+
+    async def _run(self, key, func, *args):
+        shard = self._shard(key)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executors[shard], func, shard, self.key_builder.build(key), *args)
+
+    def _read(self, shard, key, column):
+        row = self._connection(shard).execute(
+            f"SELECT {column} FROM fsm WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _write(self, shard, key, column, value):
+        conn = self._connection(shard)
+        now = time.time()
+        with conn:
+            conn.execute(f'''
+                INSERT INTO fsm (key, {column}, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET {column}=excluded.{column}, expires_at=excluded.expires_at
+            ''', (key, value, now + self.ttl))
+            if now - self._last_cleanup[shard] > self.CLEANUP_INTERVAL:
+                conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+                self._last_cleanup[shard] = now
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        state = state.state if isinstance(state, State) else state
+        await self._run(key, self._write, "state", state)
+
+    async def get_state(self, key: StorageKey):
+        return await self._run(key, self._read, "state")
+
+    async def set_data(self, key: StorageKey, data):
+        await self._run(key, self._write, "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey):
+        data = await self._run(key, self._read, "data")
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        for shard, executor in enumerate(self._executors):
+            if self._connections[shard] is not None:
+                await asyncio.get_running_loop().run_in_executor(executor, self._connections[shard].close)
+                self._connections[shard] = None
+            executor.shutdown(wait=False)
+
+
+def create_fsm_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(FSM_DB_PATH, shards=FSM_SHARDS, ttl=FSM_TTL)
+
+
 # Инициализация бота
 TOKEN = os.getenv("TOKEN")
 DEV_ID = os.getenv("DEV_ID")
 VK_USER_LOGIN = os.getenv("VK_USER_LOGIN")
 VK_USER_PASSWORD = os.getenv("VK_USER_PASSWORD")
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+
+
+def create_bot():
+    if BOT_API_URL:
+        # is_local: сервер сам читает файлы с диска, поэтому DOWNLOAD_DIR должен быть ему доступен
+        session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=True))
+        logging.info(f"Используется локальный Bot API: {BOT_API_URL}")
+        return Bot(token=TOKEN, session=session)
+    return Bot(token=TOKEN)
+
+
+bot = create_bot()
+dp = Dispatcher(storage=create_fsm_storage())
+dp.message.middleware(SlowHandlerMiddleware())
+dp.callback_query.middleware(SlowHandlerMiddleware())
+
+
+# --- ДВИЖОК ДЛЯ БЛОКИРУЮЩИХ ЗАГРУЗОК ---
+class DownloadJob:
+    """Дескриптор задачи в пуле движка. Его можно ожидать через await"""
+
+    def __init__(self, job_id, name, future):
+        self.id = job_id
+        self.name = name
+        self._future = future  # concurrent.futures.Future из пула
+        self._awaitable = asyncio.wrap_future(future)
+
+    @property
+    def status(self):
+        if self._future.cancelled():
+            return "cancelled"
+        if self._future.done():
+            return "failed" if self._future.exception() else "done"
+        return "running" if self._future.running() else "queued"
+
+    def done(self):
+        return self._future.done()
+
+    def cancel(self):
+        """Отменяет задачу, если она ещё не начала выполняться"""
+        return self._future.cancel()
+
+    def __await__(self):
+        return self._awaitable.__await__()
+
+    def __repr__(self):
+        return f"<DownloadJob #{self.id} {self.name} {self.status}>"
+
+
+class DownloadEngine:
+    """
+    Ограниченный пул потоков для yt-dlp и прочих синхронных загрузок,
+    чтобы они не блокировали event loop и остальные хэндлеры
+    :param max_workers: Максимальное количество одновременных задач
+    :param name: Префикс имен потоков
+    """
+
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, name="download"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._jobs = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, func, *args, name=None, **kwargs):
+        """Ставит функцию в пул и сразу возвращает DownloadJob"""
+        future = self._executor.submit(func, *args, **kwargs)
+        job = DownloadJob(next(self._ids), name or func.__name__, future)
+        self._jobs[job.id] = job
+        future.add_done_callback(lambda _: self._jobs.pop(job.id, None))
+        return job
+
+    async def run(self, func, *args, name=None, **kwargs):
+        """Выполняет функцию в пуле и дожидается результата"""
+        return await self.submit(func, *args, name=name, **kwargs)
+
+    @property
+    def active_jobs(self):
+        return list(self._jobs.values())
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+# Инициализация движка загрузок
+engine = DownloadEngine()
+metrics.gauge("bot_engine_jobs", lambda: len(engine.active_jobs), "Задачи в пуле загрузок yt-dlp")
+# Метаданные и поиск в своем небольшом пуле: пока идут загрузки, бот отвечает на новые ссылки сразу
+extractor = DownloadEngine(EXTRACT_WORKERS, name="extract")
+metrics.gauge("bot_extract_jobs", lambda: len(extractor.active_jobs), "Задачи в пуле извлечения метаданных")
+
+
+# --- СТАДИЯ ПОСТОБРАБОТКИ FFMPEG ---
+class PostProcessingStage:
+    """
+    Очередь задач ffmpeg со своим пулом воркеров. yt-dlp только скачивает,
+    а перепаковка и перекодирование идут сюда, поэтому одновременно
+    работает не больше workers процессов ffmpeg, сколько бы ни шло загрузок
+    :param workers: Количество воркеров (по умолчанию число ядер)
+    """
+
+    def __init__(self, workers=POSTPROCESS_WORKERS):
+        self.workers = workers
+        self.active = 0
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def queue_depth(self):
+        """Сколько задач ждет свободного воркера"""
+        return self._queue.qsize() if self._queue else 0
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.get_running_loop().create_task(self._worker()))
+
+    async def run(self, *args):
+        """Ставит вызов ffmpeg с аргументами args в очередь и ждет его завершения"""
+        self._ensure_workers()
+        set_job_state(current_job.get(), "postprocessing")
+        future = asyncio.get_running_loop().create_future()
+        # Воркеры живут дольше задачи, поэтому платформу для метрик передаем вместе с аргументами
+        self._queue.put_nowait((args, current_platform.get(), future))
+        if self.queue_depth:
+            logging.info(f"Очередь постобработки: {self.queue_depth}, в работе: {self.active}")
+        return await future
+
+    async def _worker(self):
+        while True:
+            args, platform, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            self.active += 1
+            try:
+                with metrics.timer("postprocess", platform):
+                    result = await self._ffmpeg(*args)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.active -= 1
+
+    @staticmethod
+    async def _ffmpeg(*args):
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, '-y', '-loglevel', 'error', *args,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Ошибка ffmpeg: {stderr.decode(errors='ignore').strip()[-300:]}")
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+# Инициализация стадии постобработки
+postprocessor = PostProcessingStage()
+metrics.gauge("bot_postprocess_queue_depth", lambda: postprocessor.queue_depth, "Задачи ffmpeg, ждущие воркера")
+metrics.gauge("bot_postprocess_active", lambda: postprocessor.active, "Задачи ffmpeg в работе")
+
+
+# --- ПЛАНИРОВЩИК ЗАГРУЗОК ---
+class FairScheduler:
+    """
+    Справедливое распределение слотов загрузки: у каждого пользователя своя очередь,
+    свободный слот получает следующий по кругу пользователь (round-robin), поэтому
+    пакет из 30 ссылок не задерживает остальных. Действуют общий лимит и лимиты платформ
+    :param limit: Сколько загрузок идет одновременно
+    :param platform_limits: Лимиты по платформам, например {"YouTube": 2}
+    """
+
+    def __init__(self, limit=SCHEDULER_LIMIT, platform_limits=None):
+        self.limit = limit
+        self.platform_limits = platform_limits or {}
+        self.running = 0
+        self.running_by_platform = Counter()
+        # user_id -> очередь заявок; порядок ключей задает очередность обхода
+        self._queues = OrderedDict()
+
+    def _platform_free(self, platform):
+        limit = self.platform_limits.get(platform)
+        return limit is None or self.running_by_platform[platform] < limit
+
+    def _dispatch(self):
+        while self.running < self.limit:
+            for user_id, queue in self._queues.items():
+                ticket = next((t for t in queue if self._platform_free(t[0])), None)
+                if ticket is not None:
+                    break
+            else:
+                return
+
+            queue.remove(ticket)
+            # Пользователь, получивший слот, уходит в конец круга
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+
+            platform, future = ticket
+            self.running += 1
+            self.running_by_platform[platform] += 1
+            future.set_result(None)
+
+    def _release(self, platform):
+        self.running -= 1
+        self.running_by_platform[platform] -= 1
+        self._dispatch()
+
+    def position(self, user_id, ticket):
+        """Примерное место заявки в общей очереди с учетом обхода по кругу"""
+        users = list(self._queues)
+        queue = self._queues.get(user_id)
+        if queue is None or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        for other in users:
+            if other == user_id:
+                continue
+            # Пользователи впереди по кругу успевают получить на один слот больше
+            extra = 1 if users.index(other) < users.index(user_id) else 0
+            ahead += min(len(self._queues[other]), index + extra)
+        return ahead + 1
+
+    async def run(self, user_id, platform, func, on_queued=None):
+        """
+        Дожидается слота и выполняет func
+        :param on_queued: Корутина-функция, которая получает позицию в очереди, если слот занят
+        """
+        ticket = (platform, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+
+        try:
+            if not ticket[1].done() and on_queued:
+                await on_queued(self.position(user_id, ticket))
+            await ticket[1]
+        except BaseException:
+            if ticket[1].done() and not ticket[1].cancelled():
+                self._release(platform)
+            else:
+                ticket[1].cancel()
+                queue = self._queues.get(user_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[user_id]
+            raise
+
+        try:
+            return await func()
+        finally:
+            self._release(platform)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+
+# Инициализация планировщика
+scheduler = FairScheduler(SCHEDULER_LIMIT, SCHEDULER_PLATFORM_LIMITS)
+metrics.gauge("bot_scheduler_running", lambda: scheduler.running, "Загрузки, получившие слот планировщика")
+metrics.gauge("bot_scheduler_queued", lambda: scheduler.queued, "Загрузки, ждущие слот планировщика")
+
+
+def _ydl_extract(ydl_opts, url, download=True):
+    """Синхронный вызов yt-dlp, выполняется только внутри пула движка"""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=download)
+
+
+def _ydl_process(ydl_opts, info):
+    """Скачивание по уже извлеченному info_dict, без повторного запроса страницы"""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # В кэше лежит результат extract_info с уже выбранным форматом по умолчанию (requested_formats и т.п.).
+        # Как при --load-info-json, убираем следы прошлого выбора; заодно получаем копию, которую можно менять
+        return ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+
+
+# --- КЭШ С ВРЕМЕНЕМ ЖИЗНИ ---
+class TTLCache:
+    """
+    LRU-кэш, записи которого устаревают через ttl секунд
+    :param ttl: Время жизни записи в секундах
+    :param maxsize: Максимальное количество записей, лишние вытесняются по LRU
+    """
+
+    def __init__(self, ttl, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Кэш info_dict по каноничной ссылке: метаданные, список форматов и скачивание используют одно извлечение
+info_cache = TTLCache(INFO_CACHE_TTL, maxsize=INFO_CACHE_SIZE)
+
+
+async def get_video_info(url, http_headers=None):
+    """
+    Возвращает info_dict из кэша, а при промахе извлекает его один раз
+    :param http_headers: Заголовки извлечения. Для VK по умолчанию VK_HTTP_HEADERS, как при загрузке
+    """
+    await url_router.resolve(url)
+    if http_headers is None and detect_link_type(url) == "VK_VIDEO_CLIP":
+        http_headers = VK_HTTP_HEADERS
+    # Ссылки форматов и их http_headers зависят от заголовков извлечения, поэтому они входят в ключ
+    key = (canonical_url(url), tuple(sorted((http_headers or {}).items())))
+    info = info_cache.get(key)
+    metrics.cache("info", info is not None)
+    if info is None:
+        ydl_opts = {'quiet': True, 'skip_download': True}
+        if http_headers:
+            ydl_opts['http_headers'] = http_headers
+        with metrics.timer("extract", detect_link_type(url)):
+            info = await extractor.run(_ydl_extract, ydl_opts, url, False, name="extract")
+        info_cache.set(key, info)
+    return info
+
+
+@contextlib.asynccontextmanager
+async def job_workspace(user_id):
+    """Уникальная временная папка одной задачи. Удаляется вместе с файлами после ее завершения"""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f"{user_id}_", dir=DOWNLOAD_DIR)
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@contextlib.asynccontextmanager
+async def user_semaphore(semaphores, user_id, limit):
+    """
+    Общий семафор всех задач пользователя. Хранится, пока им пользуется хотя бы одна задача,
+    чтобы словарь не рос с каждым новым пользователем
+    :param semaphores: Словарь user_id -> [семафор, число задач]
+    """
+    entry = semaphores.setdefault(user_id, [asyncio.Semaphore(limit), 0])
+    entry[1] += 1
+    try:
+        yield entry[0]
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            semaphores.pop(user_id, None)
+
+
+def downloaded_file_path(info, default):
+    """Путь к итоговому файлу, который записал yt-dlp"""
+    downloads = info.get('requested_downloads') or [{}]
+    return downloads[-1].get('filepath') or default
+
+
+async def ydl_download(url, ydl_opts, name=None):
+    """
+    Скачивает ссылку через process_ie_result, переиспользуя кэшированный info_dict.
+    Формат 'best' заменяется на лучший формат, который помещается в лимит Telegram
+    """
+    info = await get_video_info(url, ydl_opts.get('http_headers'))
+    if ydl_opts.get('format') == 'best':
+        planned = plan_format(info)
+        if planned is None:
+            raise FileTooLargeError(f"Все форматы больше лимита Telegram ({format_size(upload_limit())}) ❌")
+        ydl_opts = {**ydl_opts, 'format': planned['format_id']}
+    else:
+        check_format_size(info, ydl_opts.get('format'))
+
+    # Постобработку yt-dlp отключаем: ffmpeg запускается в отдельной стадии
+    ydl_opts = {**ydl_opts, 'fixup': 'never'}
+    result = await _ydl_process_timed(ydl_opts, info, name)
+    await _fixup_container(result)
+    return result
+
+
+async def _ydl_process_timed(ydl_opts, info, name=None):
+    """Скачивание через yt-dlp с замером стадии download и подсчетом байт"""
+    with metrics.timer("download"):
+        result = await engine.run(_ydl_process, ydl_opts, info, name=name)
+    file_path = downloaded_file_path(result, None)
+    if file_path and os.path.exists(file_path):
+        metrics.inc("bot_bytes_total", os.path.getsize(file_path), direction="download",
+                    platform=current_platform.get())
+    return result
+
+
+async def _fixup_container(info):
+    """Перепаковка, которую раньше делали фиксапы yt-dlp: HLS-поток в MP4 и DASH-контейнер m4a"""
+    file_path = downloaded_file_path(info, None)
+    if not file_path or not os.path.exists(file_path):
+        return
+    protocol = info.get('protocol') or ''
+    if not (info.get('container') == 'm4a_dash' or (protocol.startswith('m3u8') and info.get('ext') == 'mp4')):
+        return
+
+    fixed_path = f"{file_path}.fixed.{info['ext']}"
+    extra = ['-bsf:a', 'aac_adtstoasc'] if (info.get('acodec') or '').startswith('mp4a') else []
+    await postprocessor.run('-i', file_path, '-map', '0', '-dn', '-ignore_unknown', '-c', 'copy', *extra,
+                            '-f', 'mp4', fixed_path)
+    os.replace(fixed_path, file_path)
+
+
+# --- ОБЩИЙ HTTP-КЛИЕНТ ---
+class HttpClient:
+    """
+    Один aiohttp-клиент на всё приложение: keep-alive соединения, лимиты на хост и кэш DNS.
+    Сессия создается лениво внутри запущенного event loop
+    """
+
+    def __init__(self, limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl=HTTP_DNS_CACHE_TTL, user_agent=HTTP_USER_AGENT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.user_agent = user_agent
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=self.dns_cache_ttl, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                  headers={'User-Agent': self.user_agent})
+        return self._session
+
+    def request(self, method, url, user_agent=None, headers=None, **kwargs):
+        """Запрос через общий пул. user_agent переопределяет заголовок для конкретного места вызова"""
+        headers = dict(headers or {})
+        if user_agent:
+            headers['User-Agent'] = user_agent
+        return self.session.request(method, url, headers=headers, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    async def download(self, url, file_path, max_bytes, user_agent=None, headers=None):
+        """
+        Скачивает файл кусками по HTTP_CHUNK_SIZE, не держа его целиком в памяти
+        :param max_bytes: Потолок размера: при превышении загрузка прерывается
+        :return: Количество записанных байт
+        """
+        with metrics.timer("download"):
+            written = await self._download(url, file_path, max_bytes, user_agent, headers)
+        metrics.inc("bot_bytes_total", written, direction="download", platform=current_platform.get())
+        return written
+
+    async def _download(self, url, file_path, max_bytes, user_agent=None, headers=None):
+        async with self.get(url, user_agent=user_agent, headers=headers) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > max_bytes:
+                raise FileTooLargeError(f"Файл ~{format_size(response.content_length)} больше лимита "
+                                        f"Telegram ({format_size(max_bytes)}) ❌")
+
+            written = 0
+            with open(file_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(HTTP_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise FileTooLargeError(f"Файл больше лимита Telegram ({format_size(max_bytes)}) ❌")
+                    f.write(chunk)
+        return written
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+# Инициализация HTTP-клиента
+http_client = HttpClient()
 
 
 # --- КЛАСС ДЛЯ РАБОТЫ С VK ---
 class VkMusicHelper:
     def __init__(self):
-        self.service = None
         self.token = os.getenv("ACCESS_TOKEN_MUSIC")  # Убедись, что в .env есть этот ключ
-        # User-Agent для скачивания, чтобы VK не отдавал заглушку
+        # User-Agent для поиска и скачивания, чтобы VK не отдавал заглушку
         self.user_agent = "KateMobileAndroid/56 lite-armeabi-v7a (Android 4.4.2; SDK 19; armeabi-v7a; unknown unknown; ru)"
-
-    def authenticate(self):
-        """Инициализация сервиса vkpymusic"""
+        # Кэш поиска: (нормализованный запрос, limit, offset) -> список треков
+        self.search_cache = TTLCache(VK_SEARCH_CACHE_TTL, maxsize=VK_SEARCH_CACHE_SIZE)
+
+    @staticmethod
+    def normalize_query(query):
+        """'  Linkin   PARK ' и 'linkin park' — один и тот же запрос"""
+        return " ".join(query.lower().split())
+
+    async def search_tracks_async(self, query, limit=VK_SEARCH_BATCH, offset=0):
+        """
+        Поиск треков с кэшем по нормализованному запросу
+        :return: (треки, offset следующей порции или None, если VK вернул неполную порцию)
+        """
+        key = (self.normalize_query(query), limit, offset)
+        result = self.search_cache.get(key)
+        metrics.cache("vk_search", result is not None)
+        if result is None:
+            result = await self.search_tracks(query, limit, offset)
+            # Пустой результат не кэшируем: это может быть временная ошибка VK
+            if result[0] or result[1] is not None:
+                self.search_cache.set(key, result)
+        return result
+
+    async def search_tracks(self, query, limit=5, offset=0):
+        """
+        Поиск треков методом audio.search через общий HTTP-клиент (те же параметры, что у vkpymusic)
+        :return: (треки, offset следующей порции или None). Заблокированные треки отбрасываются,
+                 поэтому треков может быть меньше limit, а offset считается по ответу VK
+        """
         if not self.token:
-            logging.error("❌ VK_ACCESS_TOKEN не найден в .env")
-            return False
+            logging.error("❌ ACCESS_TOKEN_MUSIC не найден в .env")
+            return [], None
 
+        data = {
+            'access_token': self.token, 'https': 1, 'lang': 'ru', 'extended': 1, 'v': VK_MUSIC_API_VERSION,
+            'q': query, 'count': limit, 'offset': offset, 'sort': 0, 'autocomplete': 1,
+        }
         try:
-            # Инициализируем сервис, используя токен
-            # client=None, так как мы используем готовый токен
-            self.service = Service(user_agent=self.user_agent, token=self.token)
-            logging.info("✅ Сервис vkpymusic успешно инициализирован")
-            return True
-        except Exception as e:
-            logging.error(f"❌ Ошибка инициализации vkpymusic: {e}")
-            return False
-
-    def search_tracks(self, query, limit=5):
-        """Поиск треков"""
-        if not self.service:
-            if not self.authenticate():
-                return []
-
+            async with http_client.post(f"{VK_API_URL}/audio.search", data=data, user_agent=self.user_agent) as res:
+                response = await res.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Ошибка поиска VK: {e}")
+            return [], None
+
+        if 'error' in response:
+            logging.error(f"Ошибка поиска VK: {response['error'].get('error_msg')}")
+            return [], None
+        items = response.get('response', {}).get('items', [])
+        if not items:
+            logging.info("Поиск VK не дал результатов.")
+            return [], None
+
+        next_offset = offset + len(items) if len(items) >= limit else None
+        # У заблокированных треков VK отдает пустой url: скачать их нельзя, поэтому не показываем
+        tracks = [{
+            'id': f"{item['owner_id']}_{item['id']}",
+            'artist': str(item['artist']),
+            'title': str(item['title']),
+            'url': item['url'],
+            'duration': int(item['duration'])
+        } for item in items if item.get('url')]
+        return tracks, next_offset
+
+    async def get_track_urls(self, track_ids):
+        """
+        Свежие ссылки на mp3 по id треков (owner_id_id) методом audio.getById.
+        Ссылки VK подписаны и со временем истекают, поэтому в задачах хранятся только id
+        :return: Словарь id -> url, недоступных треков в нем нет
+        """
+        if not self.token or not track_ids:
+            return {}
+        data = {'access_token': self.token, 'https': 1, 'v': VK_MUSIC_API_VERSION, 'audios': ",".join(track_ids)}
         try:
-            # vkpymusic имеет удобный метод для поиска по тексту
-            # count=limit ограничивает количество
-            songs = self.service.search_songs_by_text(query, count=limit)
-
-            if not songs:
-                logging.info("Поиск vkpymusic не дал результатов.")
-                return []
-
-            tracks = []
-            for song in songs:
-                # Библиотека возвращает объекты класса Song, конвертируем их в словарь для бота
-                tracks.append({
-                    'artist': song.artist,
-                    'title': song.title,
-                    'url': song.url,
-                    'duration': song.duration
-                })
+            async with http_client.post(f"{VK_API_URL}/audio.getById", data=data, user_agent=self.user_agent) as res:
+                response = await res.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Ошибка получения треков VK: {e}")
+            return {}
+
+        if 'error' in response:
+            logging.error(f"Ошибка получения треков VK: {response['error'].get('error_msg')}")
+            return {}
+        items = response.get('response') or []
+        if isinstance(items, dict):
+            items = items.get('items', [])
+        return {f"{item['owner_id']}_{item['id']}": item['url'] for item in items if item.get('url')}
+
+    async def with_urls(self, tracks):
+        """Треки со ссылками: у треков без url (из сохраненной задачи) ссылка запрашивается заново"""
+        missing = [track['id'] for track in tracks if not track.get('url')]
+        if not missing:
             return tracks
-        except Exception as e:
-            logging.error(f"Ошибка поиска через vkpymusic: {e}")
-            return []
+        urls = await self.get_track_urls(missing)
+        return [track if track.get('url') else {**track, 'url': urls.get(track['id'])} for track in tracks]
 
     async def download_track(self, url, filename):
-        """Скачивание файла трека"""
-        try:
-            # Запускаем синхронное скачивание в отдельном потоке, чтобы не блокировать бота
-            loop = asyncio.get_event_loop()
-            success = await loop.run_in_executor(None, self._download_sync, url, filename)
-            return filename if success else None
-        except Exception as e:
-            logging.error(f"Ошибка при асинхронном запуске скачивания: {e}")
-            return None
-
-    def _download_sync(self, url, filename):
-        """Синхронная функция скачивания с правильными заголовками"""
+        """Скачивание файла трека через общий HTTP-клиент"""
         try:
             # ОЧЕНЬ ВАЖНО: передаем User-Agent при скачивании файла.
             # Иначе VK видит, что качает скрипт, и отдает mp3-заглушку.
-            headers = {
-                'User-Agent': self.user_agent
-            }
-
-            response = requests.get(url, headers=headers, stream=True, timeout=30)
-
-            if response.status_code == 200:
-                with open(filename, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=1024 * 64):
-                        if chunk:
-                            f.write(chunk)
-
-                # Проверка: если файл слишком маленький (менее 10кб), скорее всего это ошибка или заглушка
-                if os.path.getsize(filename) < 10240:
-                    logging.warning("Скачанный файл слишком маленький, возможно это заглушка.")
-                    # Можно удалить файл, если он битый, но пока оставим для диагностики
-
-                return True
-            else:
-                logging.error(f"Ошибка скачивания VK. Status code: {response.status_code}")
-                return False
+            size = await http_client.download(url, filename, upload_limit(), user_agent=self.user_agent)
+
+            # Проверка: если файл слишком маленький (менее 10кб), скорее всего это ошибка или заглушка
+            if size < 10240:
+                logging.warning("Скачанный файл слишком маленький, возможно это заглушка.")
+                # Можно удалить файл, если он битый, но пока оставим для диагностики
+
+            return filename
+        except FileTooLargeError:
+            raise
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"Ошибка скачивания VK. Status code: {e.status}")
+            return None
         except Exception as e:
             logging.error(f"Ошибка записи файла: {e}")
-            return False
+            return None
 
 
 # Инициализация хелпера
@@ -158,9 +1180,134 @@ class UserStates(StatesGroup):
     SEARCH_VK_MUSIC = State()
 
 
+# --- РАБОТА С БАЗОЙ ДАННЫХ ---
+class Database:
+    """
+    Одно долгоживущее соединение SQLite в режиме WAL.
+    Запросы выполняются в отдельном потоке, записи копятся в очереди и коммитятся пачками
+    :param path: Путь к файлу базы
+    :param batch_size: Максимальное количество записей в одной транзакции
+    :param flush_interval: Сколько секунд копить записи перед коммитом
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = None
+        # Один поток: sqlite3-соединение используется только из него
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._queue = None
+        self._writer = None
+        self._pending = 0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def execute_later(self, sql, params=()):
+        """Ставит запись в очередь и сразу возвращает управление"""
+        self._ensure_writer()
+        self._pending += 1
+        self._queue.put_nowait((sql, params, None))
+
+    async def execute(self, sql, params=()):
+        """Ставит запись в очередь и ждет коммита. Возвращает lastrowid"""
+        self._ensure_writer()
+        self._pending += 1
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, future))
+        return await future
+
+    async def flush(self):
+        """Дожидается коммита всех записей, поставленных в очередь"""
+        if self._pending:
+            await self.execute("SELECT 1")
+
+    async def fetchone(self, sql, params=()):
+        await self.flush()
+        return await self._run(lambda: self._connection().execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        await self.flush()
+        return await self._run(lambda: self._connection().execute(sql, params).fetchall())
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Ждем, пока накопятся другие записи, чтобы закоммитить их одной транзакцией
+            await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                with metrics.timer("db_write", "db"):
+                    results = await self._run(self._write_batch, [(sql, params) for sql, params, _ in batch])
+            except Exception as e:
+                logging.error(f"Ошибка записи в БД: {e}")
+                results = [e] * len(batch)
+            finally:
+                self._pending -= len(batch)
+
+            for (_, _, future), result in zip(batch, results):
+                if future is None or future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _write_batch(self, statements):
+        conn = self._connection()
+        try:
+            results = []
+            with conn:
+                for sql, params in statements:
+                    results.append(conn.execute(sql, params).lastrowid)
+            return results
+        except sqlite3.Error:
+            # Одна ошибочная запись не должна терять всю пачку: повторяем по одной
+            results = []
+            for sql, params in statements:
+                try:
+                    with conn:
+                        results.append(conn.execute(sql, params).lastrowid)
+                except sqlite3.Error as e:
+                    logging.error(f"Ошибка запроса к БД: {e}")
+                    results.append(e)
+            return results
+
+    async def close(self):
+        if self._writer is not None:
+            await self.flush()
+            self._writer.cancel()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+
 # Инициализация базы данных
+db = Database(DB_PATH, batch_size=DB_BATCH_SIZE, flush_interval=DB_FLUSH_INTERVAL)
+metrics.gauge("bot_db_pending_writes", lambda: db._pending, "Записи в очереди на коммит")
+
+
 def init_db():
-    conn = sqlite3.connect("../telegram_bot.db")
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
 
     # Таблица для пользователей
@@ -186,27 +1333,81 @@ def init_db():
         )
     ''')
 
-    # Таблица для скачанных файлов
+    # Таблица для скачанных файлов. Сами файлы удаляются вместе с папкой задачи, поэтому хранятся ссылка и название
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS downloads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
-            file_path TEXT,
+            url TEXT,
+            title TEXT,
             file_type TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    # В старых базах вместо ссылки и названия был путь к временному файлу
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(downloads)")}
+    for column in ("url", "title"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE downloads ADD COLUMN {column} TEXT")
+
+    # Кэш file_id, которые вернул Telegram после загрузки файла
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_cache (
+            url TEXT,
+            format_id TEXT,
+            media_type TEXT,
+            file_id TEXT,
+            title TEXT,
+            hits INTEGER DEFAULT 0,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (url, format_id, media_type)
+        )
+    ''')
+
+    # Таблица задач загрузки: по ней незавершенные загрузки продолжаются после перезапуска
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            kind TEXT,
+            url TEXT,
+            file_type TEXT,
+            format_id TEXT,
+            title TEXT,
+            params TEXT,
+            state TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 1,
+            error TEXT,
+            runner TEXT DEFAULT 'local',
+            worker TEXT,
+            file_id TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Колонки брокера и file_id для баз, созданных до их появления
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(jobs)")}
+    for column, definition in (("runner", "TEXT DEFAULT 'local'"), ("worker", "TEXT"), ("file_id", "TEXT")):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+
+    # Воркеры брокера: по seen_at бот понимает, есть ли кому отдать задачу
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS workers (
+            id TEXT PRIMARY KEY,
+            seen_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     conn.commit()
     conn.close()
 
 
 # Функция добавления пользователя в БД
 def save_user(user_id, username, last_url=None, last_action=None):
-    conn = sqlite3.connect("../telegram_bot.db")
-    cursor = conn.cursor()
-
-    cursor.execute('''
+    db.execute_later('''
         INSERT INTO users (id, username, last_url, last_action)
         VALUES (?, ?, ?, ?)
         ON CONFLICT(id) DO UPDATE SET
@@ -216,36 +1417,637 @@ def save_user(user_id, username, last_url=None, last_action=None):
             last_update=CURRENT_TIMESTAMP
     ''', (user_id, username, last_url, last_action))
 
-    conn.commit()
-    conn.close()
-
 
 def log_action(user_id, url, action):
-    conn = sqlite3.connect("../telegram_bot.db")
-    cursor = conn.cursor()
-
-    cursor.execute('''
+    db.execute_later('''
         INSERT INTO logs (user_id, url, action)
         VALUES (?, ?, ?)
     ''', (user_id, url, action))
 
-    conn.commit()
-    conn.close()
 
+def save_download(user_id, url, title, file_type):
+    db.execute_later('''
+        INSERT INTO downloads (user_id, url, title, file_type)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, canonical_url(url), title, file_type))
 
-def save_download(user_id, file_path, file_type):
-    conn = sqlite3.connect("../telegram_bot.db")
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        INSERT INTO downloads (user_id, file_path, file_type)
-        VALUES (?, ?, ?)
-    ''', (user_id, file_path, file_type))
+async def get_cached_file(url, format_id, media_type):
+    """Возвращает (file_id, title) из кэша или None"""
+    key = (canonical_url(url), format_id, media_type)
+    row = await db.fetchone('''
+        SELECT file_id, title FROM file_cache
+        WHERE url = ? AND format_id = ? AND media_type = ?
+    ''', key)
+
+    if row:
+        db.execute_later('''
+            UPDATE file_cache SET hits = hits + 1
+            WHERE url = ? AND format_id = ? AND media_type = ?
+        ''', key)
+    return row
+
+
+def save_cached_file(url, format_id, media_type, file_id, title):
+    db.execute_later('''
+        INSERT INTO file_cache (url, format_id, media_type, file_id, title)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(url, format_id, media_type) DO UPDATE SET
+            file_id=excluded.file_id,
+            title=excluded.title,
+            timestamp=CURRENT_TIMESTAMP
+    ''', (canonical_url(url), format_id, media_type, file_id, title))
+
+
+def delete_cached_file(url, format_id, media_type):
+    db.execute_later('''
+        DELETE FROM file_cache
+        WHERE url = ? AND format_id = ? AND media_type = ?
+    ''', (canonical_url(url), format_id, media_type))
+
+
+# Состояния задачи, в которых она еще не завершена
+JOB_ACTIVE_STATES = ("queued", "downloading", "postprocessing", "uploading")
+
+
+def new_job_id():
+    """
+    id задачи без обращения к базе: миллисекунды создания и 20 случайных бит.
+    id растут со временем (порядок задач сохраняется) и не совпадают у разных процессов с общей базой
+    """
+    return (time.time_ns() // 1_000_000) << 20 | random.getrandbits(20)
+
+
+def create_job(user_id, chat_id, kind, url, file_type, format_id, title=None, params=None):
+    """
+    Ставит в очередь записи задачу загрузки в состоянии queued и сразу возвращает ее id, не дожидаясь коммита.
+    Следующие запросы к jobs идут через ту же очередь или fetch*, поэтому видят задачу
+    :param kind: Тип задачи из job_download, по нему загрузчик восстанавливается после перезапуска
+    :param params: Дополнительные параметры загрузчика (сохраняются в JSON)
+    :return: id задачи
+    """
+    job_id = new_job_id()
+    db.execute_later('''
+        INSERT INTO jobs (id, user_id, chat_id, kind, url, file_type, format_id, title, params)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, user_id, chat_id, kind, url, file_type, format_id, title,
+          json.dumps(params or {}, ensure_ascii=False)))
+    return job_id
+
+
+def set_job_state(job_id, state, error=None):
+    """Меняет состояние задачи. Без job_id ничего не делает"""
+    if job_id is None:
+        return
+    db.execute_later('''
+        UPDATE jobs SET state = ?, error = COALESCE(?, error), updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (state, error, job_id))
+
+
+async def set_job_file(job_id, file_id):
+    """
+    Запоминает file_id отправленного файла до отметки done: если бот упадет между отправкой и отметкой,
+    задача не будет отправлена повторно. Ждет коммита. Без job_id ничего не делает
+    """
+    if job_id is None or not file_id:
+        return
+    await db.execute("UPDATE jobs SET file_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (file_id, job_id))
+
+
+def retry_job(job_id):
+    db.execute_later('''
+        UPDATE jobs SET state = 'queued', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (job_id,))
+
+
+async def fetch_jobs(where, params=()):
+    """Задачи, подходящие под условие where, в порядке создания"""
+    columns = ("id", "user_id", "chat_id", "kind", "url", "file_type", "format_id", "title", "params", "attempts",
+               "file_id")
+    rows = await db.fetchall(f"SELECT {', '.join(columns)} FROM jobs WHERE {where} ORDER BY id", params)
+    jobs = [dict(zip(columns, row)) for row in rows]
+    for job in jobs:
+        job['params'] = json.loads(job['params'] or "{}")
+    return jobs
+
+
+async def get_pending_jobs():
+    """Незавершенные задачи этого процесса. Задачи брокера продолжают воркеры"""
+    return await fetch_jobs(f"state IN ({', '.join('?' * len(JOB_ACTIVE_STATES))}) AND runner != 'broker'",
+                            JOB_ACTIVE_STATES)
+
+
+# --- БРОКЕР ЗАДАЧ ---
+def dispatch_job(job_id):
+    """Передает задачу воркерам брокера"""
+    db.execute_later('''
+        UPDATE jobs SET runner = 'broker', state = 'queued', worker = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (job_id,))
 
-    conn.commit()
-    conn.close()
 
-def get_music_page(tracks, page=0, per_page=5):
+async def broker_alive():
+    """Есть ли воркер, который отмечался в таблице workers за последний BROKER_LEASE (в том числе без задач)"""
+    row = await db.fetchone(
+        "SELECT 1 FROM workers WHERE seen_at >= datetime('now', ?) LIMIT 1", (f"-{BROKER_LEASE} seconds",))
+    return row is not None
+
+
+async def take_back_job(job_id):
+    """Забирает задачу у брокера на выполнение в этом процессе, если ее еще не взял воркер. True, если забрали"""
+    await db.execute('''
+        UPDATE jobs SET runner = 'local', updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND runner = 'broker' AND state = 'queued' AND worker IS NULL
+    ''', (job_id,))
+    row = await db.fetchone("SELECT runner FROM jobs WHERE id = ?", (job_id,))
+    return row is not None and row[0] == "local"
+
+
+class JobWaiter:
+    """
+    Ждет завершения задач брокера. Все ожидающие задачи проверяются одним запросом раз в
+    BROKER_POLL_INTERVAL, а не отдельным опросом базы на каждую задачу.
+    Если задача стоит без движения дольше BROKER_LEASE (ее никто не взял или воркер перестал продлевать аренду),
+    она возвращается в очередь, а когда живых воркеров нет — забирается обратно: тогда результат
+    ("local", None), и задачу выполняет сам вызывающий
+    """
+
+    def __init__(self):
+        self.waiting = {}
+        self._task = None
+
+    async def wait(self, job_id):
+        """:return: (state, error)"""
+        future = self.waiting.get(job_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting[job_id] = future
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.waiting.pop(job_id, None)
+
+    async def _poll(self):
+        while self.waiting:
+            await asyncio.sleep(BROKER_POLL_INTERVAL)
+            try:
+                await self._check()
+            except Exception as e:
+                logging.error(f"Ошибка опроса задач брокера: {e}")
+
+    def _resolve(self, job_id, result):
+        future = self.waiting.pop(job_id, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def _check(self):
+        ids = list(self.waiting)
+        if not ids:
+            return
+        rows = await db.fetchall(f'''
+            SELECT id, state, error, worker, updated_at < datetime('now', ?) FROM jobs
+            WHERE id IN ({", ".join("?" * len(ids))})
+        ''', (f"-{BROKER_LEASE} seconds", *ids))
+        found = {row[0]: row[1:] for row in rows}
+
+        unclaimed, requeue = [], False
+        for job_id in ids:
+            if job_id not in found:
+                self._resolve(job_id, ("failed", "Задача не найдена"))
+                continue
+            state, error, worker, stale = found[job_id]
+            if state not in JOB_ACTIVE_STATES:
+                self._resolve(job_id, (state, error))
+            elif stale and worker is not None:
+                requeue = True
+            elif stale:
+                unclaimed.append(job_id)
+
+        if requeue:
+            # Воркер пропал, а вернуть его задачи в очередь может быть некому
+            requeue_stale_jobs()
+        if unclaimed and not await broker_alive():
+            for job_id in unclaimed:
+                if await take_back_job(job_id):
+                    logging.warning(f"Задачу {job_id} не взял ни один воркер брокера, выполняю ее сам")
+                    self._resolve(job_id, ("local", None))
+
+
+# Инициализация ожидания задач брокера
+job_waiter = JobWaiter()
+
+
+async def run_remote_job(job_id):
+    """
+    Передает задачу воркерам брокера и ждет ее завершения. Возвращает (state, error).
+    Если живых воркеров нет, задача не ставится в очередь и сразу возвращается ("local", None)
+    """
+    if not await broker_alive():
+        logging.warning(f"Нет живых воркеров брокера, задачу {job_id} выполняю сам")
+        return "local", None
+    dispatch_job(job_id)
+    return await job_waiter.wait(job_id)
+
+
+async def claim_jobs(worker):
+    """
+    Забирает одну свободную задачу брокера и возвращает все задачи воркера, ждущие запуска.
+    Первыми идут пользователи, у которых сейчас меньше всего задач в работе, как в FairScheduler
+    """
+    await db.execute(f'''
+        UPDATE jobs SET worker = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id FROM jobs AS j
+            WHERE runner = 'broker' AND state = 'queued' AND worker IS NULL
+            ORDER BY (SELECT COUNT(*) FROM jobs AS r
+                      WHERE r.user_id = j.user_id AND r.runner = 'broker'
+                      AND r.state IN ({", ".join("?" * len(JOB_ACTIVE_STATES))}) AND r.worker IS NOT NULL), id
+            LIMIT 1
+        )
+    ''', (worker, *JOB_ACTIVE_STATES))
+    return await fetch_jobs("runner = 'broker' AND state = 'queued' AND worker = ?", (worker,))
+
+
+def heartbeat_jobs(worker):
+    """Отмечает воркер живым и продлевает аренду его задач"""
+    db.execute_later('''
+        INSERT INTO workers (id, seen_at) VALUES (?, CURRENT_TIMESTAMP)
+        ON CONFLICT(id) DO UPDATE SET seen_at = excluded.seen_at
+    ''', (worker,))
+    db.execute_later(f'''
+        UPDATE jobs SET updated_at = CURRENT_TIMESTAMP
+        WHERE worker = ? AND state IN ({", ".join("?" * len(JOB_ACTIVE_STATES))})
+    ''', (worker, *JOB_ACTIVE_STATES))
+
+
+def release_jobs(worker):
+    """Возвращает в очередь задачи воркера при его остановке, не дожидаясь окончания аренды"""
+    db.execute_later("DELETE FROM workers WHERE id = ?", (worker,))
+    db.execute_later(f'''
+        UPDATE jobs SET state = 'queued', worker = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE worker = ? AND state IN ({", ".join("?" * len(JOB_ACTIVE_STATES))})
+    ''', (worker, *JOB_ACTIVE_STATES))
+
+
+def requeue_stale_jobs():
+    """Возвращает в очередь задачи воркеров, которые перестали продлевать аренду"""
+    stale = f'''
+        runner = 'broker' AND worker IS NOT NULL
+        AND state IN ({", ".join("?" * len(JOB_ACTIVE_STATES))})
+        AND updated_at < datetime('now', ?)
+    '''
+    params = (*JOB_ACTIVE_STATES, f"-{BROKER_LEASE} seconds")
+    db.execute_later(f'''
+        UPDATE jobs SET state = 'failed', error = 'Превышено число попыток', updated_at = CURRENT_TIMESTAMP
+        WHERE {stale} AND attempts >= ?
+    ''', (*params, JOB_MAX_ATTEMPTS))
+    db.execute_later(f'''
+        UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE {stale}
+    ''', params)
+
+
+# --- НОРМАЛИЗАЦИЯ ССЫЛОК ---
+# Параметры, которые не влияют на содержимое ссылки
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "share_source", "_r", "_t"}
+
+_VK_HOSTS = r"(?:(?:www|m)\.)?(?:vk\.com|vk\.ru|vkvideo\.ru)"
+
+
+class UrlRouter:
+    """
+    Определяет платформу и id контента по ссылке. Разные записи одной ссылки
+    (youtu.be/x, youtube.com/watch?v=x&t=10, m.youtube.com/shorts/x, ссылки с метками)
+    приводятся к одному виду, чтобы кэши и дедупликация видели одно и то же видео.
+    Короткие ссылки TikTok раскрываются один раз и запоминаются
+    :param cache_ttl: Время жизни раскрытой короткой ссылки в секундах
+    :param cache_size: Сколько раскрытых коротких ссылок хранить
+    """
+
+    # (платформа, шаблон с id контента в первой группе, каноничная ссылка)
+    ROUTES = [
+        ("YouTube", re.compile(
+            r"https?://(?:(?:www|m|music)\.)?youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/)([\w-]{11})",
+            re.I), "https://www.youtube.com/watch?v={}"),
+        ("YouTube", re.compile(r"https?://youtu\.be/([\w-]{11})", re.I), "https://www.youtube.com/watch?v={}"),
+        ("VK_VIDEO_CLIP", re.compile(rf"https?://{_VK_HOSTS}/(?:[^#]*[?&]z=)?((?:video|clip)-?\d+_\d+)", re.I),
+         "https://vk.com/{}"),
+        ("VK_STORY", re.compile(rf"https?://{_VK_HOSTS}/(story-?\d+_\d+)", re.I), "https://vk.com/{}"),
+        ("TikTok", re.compile(
+            r"https?://(?:(?:www|m)\.)?tiktok\.com/(?:@[\w.-]*/(?:video|photo)/|v/|embed/(?:v2/)?)(\d+)", re.I),
+         "https://www.tiktok.com/@/video/{}"),
+        ("Rutube", re.compile(r"https?://(?:www\.)?rutube\.ru/(?:video|shorts|play/embed)/(?:private/)?([0-9a-f]{32})",
+                              re.I), "https://rutube.ru/video/{}/"),
+    ]
+
+    # Ссылки платформы без id контента (плейлисты, каналы): платформа известна, ключ — общая нормализация
+    HOSTS = [
+        ("YouTube", re.compile(r"https?://(?:[\w-]+\.)?(?:youtube\.com|youtu\.be)(?:[/?#:]|$)", re.I)),
+        ("VK_VIDEO_CLIP", re.compile(rf"https?://{_VK_HOSTS}/(?:video|clip)", re.I)),
+        ("VK_STORY", re.compile(rf"https?://{_VK_HOSTS}/story", re.I)),
+        ("Rutube", re.compile(r"https?://(?:[\w-]+\.)?rutube\.ru(?:[/?#:]|$)", re.I)),
+        ("TikTok", re.compile(r"https?://(?:[\w-]+\.)?tiktok\.com(?:[/?#:]|$)", re.I)),
+    ]
+
+    SHORT_LINK = re.compile(r"https?://(?:(?:vt|vm)\.tiktok\.com/[\w-]+|(?:www\.)?tiktok\.com/t/[\w-]+)", re.I)
+
+    def __init__(self, cache_ttl, cache_size):
+        self.resolved = TTLCache(cache_ttl, maxsize=cache_size)
+        self._resolving = {}
+
+    @staticmethod
+    def _absolute(url):
+        """Ссылки вида youtu.be/x пользователи часто присылают без схемы"""
+        url = url.strip()
+        if "://" not in url and "." in url.split("/", 1)[0]:
+            return "https://" + url
+        return url
+
+    def route(self, url):
+        """
+        :return: (платформа, id контента). Если id не удалось выделить — (платформа, None),
+                 если ссылка не поддерживается — (None, None)
+        """
+        url = self._absolute(url)
+        url = self.resolved.get(url, url)
+        for platform, pattern, _ in self.ROUTES:
+            match = pattern.match(url)
+            if match:
+                return platform, self._content_id(platform, match.group(1))
+        for platform, pattern in self.HOSTS:
+            if pattern.match(url):
+                return platform, None
+        return None, None
+
+    @staticmethod
+    def _content_id(platform, content_id):
+        # Регистр важен только для id YouTube
+        return content_id if platform == "YouTube" else content_id.lower()
+
+    def canonical(self, url):
+        """Каноничная ссылка на контент для ключей кэша"""
+        url = self._absolute(url)
+        url = self.resolved.get(url, url)
+        for platform, pattern, template in self.ROUTES:
+            match = pattern.match(url)
+            if match:
+                return template.format(self._content_id(platform, match.group(1)))
+        return self._normalize(url)
+
+    @staticmethod
+    def _normalize(url):
+        """Общая нормализация для ссылок без известного id: хост, схема, порядок параметров, метки"""
+        parts = urllib.parse.urlsplit(url)
+        if not parts.netloc:
+            return url
+        host = parts.netloc.lower()
+        if host.startswith("www."):
+            host = host[4:]
+        query = sorted(
+            (k, v) for k, v in urllib.parse.parse_qsl(parts.query)
+            if k not in TRACKING_PARAMS and not k.startswith("utm_")
+        )
+        return urllib.parse.urlunsplit(
+            (parts.scheme.lower() or "https", host, parts.path.rstrip("/"), urllib.parse.urlencode(query), ""))
+
+    async def resolve(self, url):
+        """
+        Раскрывает короткую ссылку TikTok, чтобы canonical() и route() увидели id видео.
+        Одновременные запросы одной ссылки ждут один редирект, ошибка не кэшируется
+        :return: Полная ссылка или исходная, если раскрывать нечего
+        """
+        url = self._absolute(url)
+        if not self.SHORT_LINK.match(url):
+            return url
+        resolved = self.resolved.get(url)
+        metrics.cache("short_link", resolved is not None)
+        if resolved is not None:
+            return resolved
+
+        future = self._resolving.get(url)
+        if future is None:
+            future = asyncio.ensure_future(self._follow(url))
+            self._resolving[url] = future
+            future.add_done_callback(lambda _: self._resolving.pop(url, None))
+        return await asyncio.shield(future)
+
+    async def _follow(self, url):
+        try:
+            async with http_client.get(url, allow_redirects=True) as response:
+                resolved = str(response.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+            return url
+        self.resolved.set(url, resolved)
+        logging.info(f"Короткая ссылка {url} ведет на {resolved}")
+        return resolved
+
+
+# Инициализация маршрутизатора ссылок
+url_router = UrlRouter(SHORT_LINK_CACHE_TTL, SHORT_LINK_CACHE_SIZE)
+
+
+def canonical_url(url):
+    """Приводит ссылку к единому виду для ключей кэша"""
+    return url_router.canonical(url)
+
+
+# --- КЭШ ФАЙЛОВ НА ДИСКЕ ---
+class MediaCache:
+    """
+    Готовые файлы на диске, чтобы повторный запрос не запускал yt-dlp, даже если file_id не подходит
+    (например, другой токен бота). Ключ — (каноничная ссылка, format_id, профиль обработки),
+    а файл хранится под sha256 содержимого, поэтому одинаковые файлы лежат в одном экземпляре.
+    Индекс в SQLite: файл сначала атомарно кладется на место и только потом попадает в индекс,
+    при вытеснении наоборот, а при запуске записи без файлов и файлы без записей убираются
+    :param path: Папка кэша
+    :param max_bytes: Квота в байтах, лишнее вытесняется по LRU. 0 выключает кэш
+    """
+
+    # Файлы без записи в индексе моложе этого возраста (сек.) может дописывать другой процесс
+    ORPHAN_AGE = 3600
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(path, "objects")
+        self.db = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _object_path(self, digest, ext):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.{ext}")
+
+    @staticmethod
+    def _key(url, format_id, profile):
+        return json.dumps([canonical_url(url), format_id, profile])
+
+    def open(self):
+        """Создает индекс и сверяет его с файлами на диске"""
+        if not self.enabled or self.db is not None:
+            return
+        os.makedirs(self.objects_dir, exist_ok=True)
+        index_path = os.path.join(self.path, "index.db")
+        conn = sqlite3.connect(index_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS objects (
+                digest TEXT PRIMARY KEY,
+                ext TEXT,
+                size INTEGER,
+                last_used REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                digest TEXT,
+                title TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS objects_lru ON objects (last_used)')
+        conn.commit()
+        self._reconcile(conn)
+        conn.close()
+        self.db = Database(index_path)
+
+    def _reconcile(self, conn):
+        known = set()
+        for digest, ext in conn.execute("SELECT digest, ext FROM objects").fetchall():
+            path = self._object_path(digest, ext)
+            if os.path.exists(path):
+                known.add(path)
+            else:
+                conn.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        conn.execute("DELETE FROM entries WHERE digest NOT IN (SELECT digest FROM objects)")
+        conn.commit()
+
+        # Недописанные файлы и файлы, не попавшие в индекс из-за падения
+        removed = 0
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                with contextlib.suppress(FileNotFoundError):
+                    if path not in known and time.time() - os.path.getmtime(path) > self.ORPHAN_AGE:
+                        os.remove(path)
+                        removed += 1
+        if removed:
+            logging.info(f"Кэш файлов: удалено файлов без записи в индексе: {removed}")
+
+    @staticmethod
+    def _link(source, target):
+        """Жесткая ссылка, а между разными дисками — копия"""
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not os.path.exists(source):
+                raise
+            shutil.copyfile(source, target)
+
+    def _store(self, file_path):
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        ext = Path(file_path).suffix.lstrip('.') or 'bin'
+        target = self._object_path(digest, ext)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temp_path = f"{target}.{os.getpid()}.tmp"
+            self._link(file_path, temp_path)
+            os.replace(temp_path, target)
+        return digest, ext, os.path.getsize(target)
+
+    async def get(self, url, format_id, profile, workdir):
+        """
+        Кладет файл из кэша в папку задачи
+        :return: (file_path, title) или None при промахе
+        """
+        if self.db is None:
+            return None
+        row = await self.db.fetchone('''
+            SELECT o.digest, o.ext, e.title FROM entries AS e JOIN objects AS o ON o.digest = e.digest
+            WHERE e.key = ?
+        ''', (self._key(url, format_id, profile),))
+        metrics.cache("media", row is not None)
+        if row is None:
+            return None
+
+        digest, ext, title = row
+        target = os.path.join(workdir, f"{digest}.{ext}")
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._link, self._object_path(digest, ext), target)
+        except FileNotFoundError:
+            # Файл вытеснил другой процесс
+            self.db.execute_later("DELETE FROM entries WHERE digest = ?", (digest,))
+            self.db.execute_later("DELETE FROM objects WHERE digest = ?", (digest,))
+            return None
+        self.db.execute_later("UPDATE objects SET last_used = ? WHERE digest = ?", (time.time(), digest))
+        return target, title
+
+    async def put(self, url, format_id, profile, file_path, title):
+        """Сохраняет готовый файл в кэш и вытесняет давно не использованные файлы сверх квоты"""
+        if self.db is None or not file_path or not os.path.exists(file_path):
+            return
+        try:
+            digest, ext, size = await asyncio.get_running_loop().run_in_executor(None, self._store, file_path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить файл в кэш: {e}")
+            return
+
+        self.db.execute_later('''
+            INSERT INTO objects (digest, ext, size, last_used) VALUES (?, ?, ?, ?)
+            ON CONFLICT(digest) DO UPDATE SET last_used = excluded.last_used
+        ''', (digest, ext, size, time.time()))
+        self.db.execute_later('''
+            INSERT INTO entries (key, digest, title) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET digest = excluded.digest, title = excluded.title
+        ''', (self._key(url, format_id, profile), digest, title))
+        await self._evict()
+
+    async def _evict(self):
+        total = (await self.db.fetchone("SELECT COALESCE(SUM(size), 0) FROM objects"))[0]
+        if total <= self.max_bytes:
+            return
+
+        victims = []
+        for digest, ext, size in await self.db.fetchall("SELECT digest, ext, size FROM objects ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            victims.append((digest, ext))
+            total -= size
+        for digest, _ in victims:
+            self.db.execute_later("DELETE FROM entries WHERE digest = ?", (digest,))
+            self.db.execute_later("DELETE FROM objects WHERE digest = ?", (digest,))
+        await self.db.flush()
+
+        # Файлы удаляются после индекса: при падении между шагами останется только файл-сирота
+        for digest, ext in victims:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._object_path(digest, ext))
+        logging.info(f"Кэш файлов: вытеснено {len(victims)}, занято {format_size(total)}")
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+
+# Инициализация кэша файлов
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+
+def get_music_page(tracks, page=0, per_page=MUSIC_PAGE_SIZE):
     """
     Генерирует текст и клавиатуру для определенной страницы результатов
     :param tracks: Список всех найденных треков
@@ -284,6 +2086,11 @@ def get_music_page(tracks, page=0, per_page=5):
             InlineKeyboardButton(text=f"📥 Скачать {abs_index + 1}", callback_data=f"music_dl_{abs_index}")
         ])
 
+    # Скачать все треки страницы одним альбомом
+    keyboard_buttons.append([
+        InlineKeyboardButton(text="📥 Скачать всю страницу", callback_data=f"music_dlpage_{page}")
+    ])
+
     # Кнопки навигации (Назад / Стр / Вперед)
     nav_row = []
     if page > 0:
@@ -381,19 +2188,9 @@ def search_select_keyboard():
 
 # Определение типа ссылки
 def detect_link_type(url):
-    if "youtube.com" in url or "youtu.be" in url:
-        return "YouTube"
-    elif "vk.com/video" in url or "vk.com/clip" in url:
-        return "VK_VIDEO_CLIP"
-    elif "vk.com/story" in url:
-        return "VK_STORY"
-    elif "rutube.ru" in url:
-        return "Rutube"
-    elif "vt.tiktok.com" in url or "tiktok.com" in url:
-        return "TikTok"
-    elif "Отмена ❌" in url:
+    if "Отмена ❌" in url:
         return "отмена ❌"
-    return None
+    return url_router.route(url)[0]
 
 
 @dp.message(UserStates.COLLECT_URLS)
@@ -406,54 +2203,86 @@ async def collect_urls_handler(message: types.Message, state: FSMContext):
 
     await state.update_data(url_queue=urls)
     await message.answer(f"Добавлено {len(urls)} ссылок в очередь. Начинаю обработку...")
-    await process_next_url(message, state)
+    await process_url_batch(message, state)
 
 
-async def process_next_url(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    url_queue = data.get("url_queue", [])
+# Семафоры пакетной обработки: ограничивают число одновременных загрузок одного пользователя.
+# Запись удаляется, когда у пользователя не остается пакетов в работе
+batch_semaphores = {}
 
-    if not url_queue:
-        await message.answer("Все ссылки успешно обработаны ✅.")
-        await state.set_state(UserStates.START)
-        return
 
-    # Берем первую ссылку из очереди
-    current_url = url_queue.pop(0)
-    await state.update_data(url_queue=url_queue)
+def batch_job(link_type):
+    """
+    Параметры задачи для ссылки из пакета
+    :return: (kind, format_id, подпись) или None, если тип не поддерживается
+    """
+    if link_type == "YouTube":
+        return "youtube_video", "best", None
+    elif link_type == "TikTok":
+        return "tiktok", "best", None
+    elif link_type == "VK_VIDEO_CLIP":
+        return "vk_video", "best", None
+    elif link_type == "VK_STORY":
+        return "vk_story", "720", "VK Story"
+    elif link_type == "Rutube":
+        return "rutube", "best", None
+    return None
+
 
-    # Распознаем тип ссылки
-    link_type = detect_link_type(current_url)
-    if not link_type:
-        await message.answer(f"Ссылка `{current_url}` не поддерживается или некорректна ❌. Перехожу к следующей...")
-        await process_next_url(message, state)
-        return
+async def process_batch_url(message: types.Message, url: str, job_id=None):
+    """Скачивает и отправляет одну ссылку из пакета. Возвращает статус: ok, failed или unsupported"""
+    job = batch_job(detect_link_type(url))
+    if not job:
+        await message.answer(f"Ссылка `{url}` не поддерживается или некорректна ❌.")
+        return "unsupported"
 
+    kind, format_id, title = job
     try:
-        # Скачиваем и отправляем контент в зависимости от типа ссылки
-        if link_type == "YouTube":
-            file_path, title = await download_video_with_quality(current_url, {'format_id': 'best'},
-                                                                 message.from_user.id)
-            await send_file(message, file_path, title, file_type="video")
-        elif link_type == "TikTok":
-            file_path, title = await download_tiktok_video(current_url, message.from_user.id)
-            await send_file(message, file_path, title, file_type="video")
-        elif link_type == "VK_VIDEO_CLIP":
-            file_path, title = await download_vk_content(current_url, message.from_user.id)
-            await send_file(message, file_path, title, file_type="video")
-        elif link_type == "VK_STORY":
-            file_path, _ = await download_vk_history(current_url, message.from_user.id)
-            await send_file(message, file_path, "VK Story", file_type="video")
-        elif link_type == "Rutube":
-            file_path, title = await download_rutube_video(current_url, message.from_user.id)
-            await send_file(message, file_path, title, file_type="video")
-        else:
-            await message.answer(f"Тип ссылки `{current_url}` пока не поддерживается ❌.")
+        sent = await deliver_job(message, message.from_user.id, kind, url, "video", format_id, title=title,
+                                 job_id=job_id)
+        return "ok" if sent else "failed"
     except Exception as e:
-        await message.answer(f"Ошибка при обработке `{current_url}`: {e}")
+        await message.answer(f"Ошибка при обработке `{url}`: {e}")
+        return "failed"
 
-    # Переходим к следующей ссылке
-    await process_next_url(message, state)
+
+async def process_url_batch(message: types.Message, state: FSMContext):
+    """
+    Обрабатывает url_queue параллельно, не более BATCH_CONCURRENCY ссылок одного пользователя одновременно.
+    Каждый файл отправляется сразу после загрузки, в конце приходит сводка
+    """
+    data = await state.get_data()
+    url_queue = list(data.get("url_queue", []))
+    user_id = message.from_user.id
+    # Все ссылки записываются в jobs до начала загрузок: после перезапуска бот продолжит пакет
+    supported = {idx: batch_job(detect_link_type(url)) for idx, url in enumerate(url_queue)}
+    supported = {idx: job for idx, job in supported.items() if job}
+    job_ids = {idx: create_job(user_id, message.chat.id, kind, url_queue[idx], "video", format_id, title)
+               for idx, (kind, format_id, title) in supported.items()}
+
+    async def run(idx, url, semaphore):
+        async with semaphore:
+            started = time.monotonic()
+            status = await process_batch_url(message, url, job_ids.get(idx))
+            return idx, status, time.monotonic() - started
+
+    results = {}
+    async with user_semaphore(batch_semaphores, user_id, BATCH_CONCURRENCY) as semaphore:
+        for finished in asyncio.as_completed([run(idx, url, semaphore) for idx, url in enumerate(url_queue)]):
+            idx, status, elapsed = await finished
+            results[idx] = (status, elapsed)
+            # В очереди остаются только необработанные ссылки
+            await state.update_data(url_queue=[u for i, u in enumerate(url_queue) if i not in results])
+
+    status_icons = {"ok": "✅", "failed": "❌", "unsupported": "⚠️"}
+    done = sum(1 for status, _ in results.values() if status == "ok")
+    summary = [f"Обработано ссылок: {done}/{len(url_queue)}\n"]
+    for idx, url in enumerate(url_queue):
+        status, elapsed = results[idx]
+        summary.append(f"{idx + 1}. {status_icons[status]} {url} — {elapsed:.1f} сек.")
+
+    await message.answer("\n".join(summary), disable_web_page_preview=True)
+    await state.set_state(UserStates.START)
 
 
 @dp.message(UserStates.SEARCH_YT)
@@ -547,15 +2376,15 @@ async def process_vk_music_search(message: types.Message, state: FSMContext):
     await message.answer(f"🔎 Ищу в VK: {query}...")
 
     # 🔥 ЗАПРАШИВАЕМ 50 ТРЕКОВ
-    tracks = vk_helper.search_tracks(query, limit=50)
+    tracks, next_offset = await vk_helper.search_tracks_async(query, limit=VK_SEARCH_BATCH)
 
     if not tracks:
         await message.answer("Ничего не найдено 😔.\nПопробуйте другой запрос.")
         # Не сбрасываем состояние, даем возможность ввести другой запрос
         return
 
-    # Сохраняем результаты и текущую страницу (0) в FSM
-    await state.update_data(vk_tracks=tracks, current_page=0)
+    # Сохраняем результаты, запрос (для подгрузки) и текущую страницу (0) в FSM
+    await state.update_data(vk_tracks=tracks, vk_query=query, vk_offset=next_offset, current_page=0)
 
     # Генерируем первую страницу
     text, kb = get_music_page(tracks, page=0)
@@ -563,6 +2392,117 @@ async def process_vk_music_search(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
 
 
+def track_cache_url(track):
+    """Ключ трека для кэша: ссылки на mp3 у VK временные, поэтому используем id трека"""
+    return f"vk_audio:{track.get('id') or track['url']}"
+
+
+# Семафоры загрузки треков: ограничивают число одновременных загрузок одного пользователя.
+# Запись удаляется, когда у пользователя не остается альбомов в отправке
+music_semaphores = {}
+
+
+async def send_tracks_album(message: types.Message, tracks, user_id):
+    """
+    Скачивает треки параллельно (не более MUSIC_CONCURRENCY на пользователя)
+    и отправляет их одним альбомом. Уже загруженные в Telegram треки берутся из кэша file_id
+    """
+    current_platform.set("VK_MUSIC")
+    set_job_state(current_job.get(), "downloading")
+
+    async with user_semaphore(music_semaphores, user_id, MUSIC_CONCURRENCY) as semaphore, \
+            job_workspace(user_id) as workdir:
+        async def prepare(idx, track):
+            cached = await get_cached_file(track_cache_url(track), "mp3", "audio")
+            metrics.cache("file_id", cached is not None)
+            if cached:
+                return cached[0]
+            cached = await media_cache.get(track_cache_url(track), "mp3", "audio", workdir)
+            if cached:
+                file_path = cached[0]
+            elif not track.get('url'):
+                # Ссылку не удалось получить заново: трек удален или заблокирован
+                return None
+            else:
+                async with semaphore:
+                    file_path = await scheduler.run(
+                        user_id, "VK_MUSIC",
+                        lambda: vk_helper.download_track(track['url'], os.path.join(workdir, f"{idx}.mp3")))
+                await media_cache.put(track_cache_url(track), "mp3", "audio", file_path,
+                                      f"{track['artist']} - {track['title']}")
+            if not file_path:
+                return None
+            return Path(file_path).resolve().as_uri() if BOT_API_URL else FSInputFile(file_path)
+
+        files = await asyncio.gather(*[prepare(idx, track) for idx, track in enumerate(tracks)],
+                                     return_exceptions=True)
+
+        album = []
+        for track, file in zip(tracks, files):
+            if file is None or isinstance(file, Exception):
+                await message.answer(f"Не удалось скачать: {track['artist']} - {track['title']} 😔")
+                continue
+            album.append((track, InputMediaAudio(media=file, performer=track['artist'], title=track['title'],
+                                                 duration=track.get('duration'))))
+
+        if not album:
+            return False
+        set_job_state(current_job.get(), "uploading")
+        if len(album) == 1:
+            # Альбом из одного файла Telegram не принимает
+            track, media = album[0]
+            with metrics.timer("upload"):
+                file_id = await send_media(message, media.media, f"{track['artist']} - {track['title']}", "audio")
+            sent_ids = [file_id]
+        else:
+            with metrics.timer("upload"):
+                sent = await message.answer_media_group(media=[media for _, media in album])
+            sent_ids = [(msg.audio or msg.document).file_id for msg in sent]
+
+        # У альбома в задаче запоминаются file_id всех отправленных треков
+        await set_job_file(current_job.get(), ",".join(sent_ids))
+        for (track, _), file_id in zip(album, sent_ids):
+            save_cached_file(track_cache_url(track), "mp3", "audio", file_id,
+                             f"{track['artist']} - {track['title']}")
+        return True
+
+
+# Фоновые задачи подгрузки, ключ — id сообщения с результатами
+music_prefetch_tasks = {}
+
+
+def prefetch_music_page(message: types.Message, state: FSMContext, query, offset):
+    """
+    Запускает в фоне поиск следующей порции треков, если VK вернул полную порцию
+    :param offset: offset следующей порции в выдаче VK (None — треков больше нет)
+    """
+    if not query or offset is None or message.message_id in music_prefetch_tasks:
+        return
+    task = asyncio.create_task(_prefetch_music_page(message, state, query, offset))
+    music_prefetch_tasks[message.message_id] = task
+    task.add_done_callback(lambda _: music_prefetch_tasks.pop(message.message_id, None))
+
+
+async def _prefetch_music_page(message: types.Message, state: FSMContext, query, offset):
+    try:
+        more, next_offset = await vk_helper.search_tracks_async(query, limit=VK_SEARCH_BATCH, offset=offset)
+
+        # Пока шел поиск, пользователь мог начать новый: дописываем только в тот же список
+        data = await state.get_data()
+        if data.get("vk_query") != query or data.get("vk_offset") != offset:
+            return
+        tracks = data.get("vk_tracks", []) + more
+        await state.update_data(vk_tracks=tracks, vk_offset=next_offset)
+        if not more:
+            return
+
+        # Перерисовываем текущую страницу, чтобы появилась кнопка ➡️
+        text, kb = get_music_page(tracks, page=data.get("current_page", 0))
+        await message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logging.warning(f"Не удалось подгрузить следующую страницу VK: {e}")
+
+
 @dp.callback_query(F.data.startswith("music_"))
 async def handle_music_callback(callback: CallbackQuery, state: FSMContext):
     data = callback.data
@@ -599,10 +2539,33 @@ async def handle_music_callback(callback: CallbackQuery, state: FSMContext):
         except Exception:
             pass  # Если текст не изменился, Telegram кинет ошибку, игнорируем
 
+        # Дошли до последней страницы — заранее подгружаем следующие 50 треков
+        if (new_page + 1) * MUSIC_PAGE_SIZE >= len(tracks):
+            prefetch_music_page(callback.message, state, state_data.get("vk_query"), state_data.get("vk_offset"))
+
         await callback.answer()
         return
 
-    # --- 3. СКАЧИВАНИЕ ТРЕКА ---
+    # --- 3. СКАЧИВАНИЕ ВСЕЙ СТРАНИЦЫ ---
+    if data.startswith("music_dlpage_"):
+        page = int(data.split("_")[2])
+        page_tracks = tracks[page * MUSIC_PAGE_SIZE:(page + 1) * MUSIC_PAGE_SIZE]
+
+        await callback.answer(f"Загружаю {len(page_tracks)} треков...")
+        await callback.message.answer(f"⏳ Скачиваю страницу {page + 1}: {len(page_tracks)} треков...")
+        try:
+            # Ссылки на mp3 истекают, поэтому в задаче сохраняются треки без них
+            saved_tracks = [{k: v for k, v in track.items() if k != 'url'} for track in page_tracks]
+            job_id = create_job(callback.from_user.id, callback.message.chat.id, "vk_music_page", None,
+                                "audio", "mp3", params={'tracks': saved_tracks})
+            await run_job(job_id, lambda: deliver_tracks_album(callback.message, callback.from_user.id, page_tracks,
+                                                               job_id))
+        except Exception as e:
+            logging.error(f"Error music page download: {e}")
+            await callback.message.answer("Произошла ошибка при загрузке.")
+        return
+
+    # --- 4. СКАЧИВАНИЕ ТРЕКА ---
     if data.startswith("music_dl_"):
         try:
             index = int(data.split("_")[2])
@@ -617,15 +2580,15 @@ async def handle_music_callback(callback: CallbackQuery, state: FSMContext):
             await callback.answer(f"Загружаю: {track['title']}...")
             await callback.message.answer(f"⏳ Скачиваю: {track['artist']} - {track['title']}...")
 
-            # Скачиваем
-            filename = f"{callback.from_user.id}_music.mp3"
-            file_path = await vk_helper.download_track(track['url'], filename)
-
-            if file_path:
-                await send_file(callback.message, file_path, f"{track['artist']} - {track['title']}", "audio")
-                # Кнопка "Готово" не обязательна, пользователь может продолжить качать из списка выше
-            else:
-                await callback.message.answer("Ошибка при скачивании файла 😔")
+            # Скачиваем (или берем file_id из кэша)
+            title = f"{track['artist']} - {track['title']}"
+            params = {'track_id': track['id'], 'title': title}
+            # В задаче сохраняется только id трека, а свежая ссылка на mp3 передается загрузчику напрямую
+            job_id = create_job(callback.from_user.id, callback.message.chat.id, "vk_music",
+                                track_cache_url(track), "audio", "mp3", params=params)
+            await deliver_job(callback.message, callback.from_user.id, "vk_music", track_cache_url(track), "audio",
+                              "mp3", params={**params, 'track_url': track['url']}, job_id=job_id)
+            # Кнопка "Готово" не обязательна, пользователь может продолжить качать из списка выше
 
         except Exception as e:
             logging.error(f"Error music download: {e}")
@@ -794,46 +2757,44 @@ async def handle_action_selection(message: types.Message, state: FSMContext):
             await state.set_state(UserStates.START)
             return
         keyboard = ReplyKeyboardMarkup(
-            keyboard=[[types.KeyboardButton(text=f"{f['resolution']} - {f['ext']}")] for f in formats] +
+            keyboard=[[types.KeyboardButton(text=format_label(f))] for f in formats] +
                      [[types.KeyboardButton(text="Назад ◀️")]],
             resize_keyboard=True
         )
         if action == "Назад ◀️":
             await message.answer("Возврат в главное меню ◀️.", reply_markup=keyboard)
             await state.set_state(UserStates.START)
-        await message.answer("Выберите качество видео 📼:", reply_markup=keyboard)
+        text = "Выберите качество видео 📼:"
+        if not all(f['fits'] for f in formats):
+            text += f"\n⚠️ — файл больше {format_size(upload_limit())} и не пройдет в Telegram"
+        await message.answer(text, reply_markup=keyboard)
         await state.update_data(formats=formats)
         await state.set_state(UserStates.SELECT_QUALITY)
 
     elif action == "скачать аудио 🎵" and link_type == "YouTube":
-        file_path, title = await download_audio(url, message.from_user.id)
-        await send_file(message, file_path, title, file_type="audio")
+        await deliver_job(message, message.from_user.id, "youtube_audio", url, "audio", "audio")
         await message.answer("Загрузка завершена ✅ Что дальше?",
                              reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
 
     elif action == "скачать vk видео/клип 🎥" and link_type == "VK_VIDEO_CLIP":
-        file_path, title = await download_vk_content(url, message.from_user.id)
-        await send_file(message, file_path, title, file_type="video")
+        await deliver_job(message, message.from_user.id, "vk_video", url, "video", "best")
         await message.answer("Загрузка завершена ✅ Что дальше?", reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
 
     elif action == "скачать vk историю 🎥" and link_type == "VK_STORY":
-        file_path, _ = await download_vk_history(url, message.from_user.id)
-        await send_file(message, file_path, "VK: " + url, file_type="video")
+        await deliver_job(message, message.from_user.id, "vk_story", url, "video", "720", title="VK: " + url)
         await message.answer("Загрузка завершена ✅ Что дальше?", reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
 
     elif action == "скачать видео с rutube 📺" and link_type == "Rutube":
         await message.answer("Видео загружается...")
-        file_path, title = await download_rutube_video(url, message.from_user.id)
-        await send_file(message, file_path, title, file_type="video")
+        await deliver_job(message, message.from_user.id, "rutube", url, "video", "best")
         await message.answer("Загрузка завершена ✅ Что дальше?", reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
 
     elif action == "скачать tiktok видео 📱" and link_type == "TikTok":
-        file_path, title = await download_tiktok_video(url, message.from_user.id)
-        await send_file(message, file_path, title, file_type="video")
+        await deliver_job(message, message.from_user.id, "tiktok", url, "video", "best")
         await message.answer("Загрузка завершена ✅ Что дальше?", reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
 
@@ -844,30 +2805,28 @@ async def handle_action_selection(message: types.Message, state: FSMContext):
         await message.answer("Неподдерживаемое действие ❌. Попробуйте снова.")
 
 
-async def download_tiktok_video(url, user_id):
+async def download_tiktok_video(url, user_id, workdir):
     ydl_opts = {
         'format': 'best',
-        'outtmpl': f'{user_id}_tiktok.%(ext)s',
+        'outtmpl': os.path.join(workdir, 'tiktok.%(ext)s'),
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        file_path = f"{user_id}_tiktok.{info['ext']}"
-        title = info.get("title", "TikTok")
-        save_download(user_id, file_path, 'video')
-        return file_path, title
+    info = await ydl_download(url, ydl_opts, name="tiktok")
+    file_path = downloaded_file_path(info, os.path.join(workdir, f"tiktok.{info['ext']}"))
+    title = info.get("title", "TikTok")
+    save_download(user_id, url, title, 'video')
+    return file_path, title
 
 
-async def download_rutube_video(url, user_id):
+async def download_rutube_video(url, user_id, workdir):
     ydl_opts = {
         'format': 'best',
-        'outtmpl': f'{user_id}_rutube.%(ext)s',
+        'outtmpl': os.path.join(workdir, 'rutube.%(ext)s'),
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        file_path = f"{user_id}_rutube.{info['ext']}"
-        title = info.get("title", "Rutube")
-        save_download(user_id, file_path, 'video')
-        return file_path, title
+    info = await ydl_download(url, ydl_opts, name="rutube")
+    file_path = downloaded_file_path(info, os.path.join(workdir, f"rutube.{info['ext']}"))
+    title = info.get("title", "Rutube")
+    save_download(user_id, url, title, 'video')
+    return file_path, title
 
 
 @dp.message(UserStates.SELECT_QUALITY)
@@ -876,12 +2835,15 @@ async def handle_quality_selection(message: types.Message, state: FSMContext):
     data = await state.get_data()
     formats = data.get("formats")
 
-    selected_format = next((f for f in formats if f"{f['resolution']} - {f['ext']}" == selection), None)
-    if selected_format:
+    selected_format = next((f for f in formats if format_label(f) == selection), None)
+    if selected_format and not selected_format.get('fits', True):
+        await message.answer(f"Этот формат больше {format_size(upload_limit())} и не пройдет в Telegram ❌. "
+                             f"Выберите качество пониже.")
+    elif selected_format:
         await message.answer(
             f"Вы выбрали качество: {selected_format['resolution']} {selected_format['ext']}. Видео загружается...")
-        file_path, title = await download_video_with_quality(data.get("url"), selected_format, message.from_user.id)
-        await send_file(message, file_path, title, file_type="video")
+        url = data.get("url")
+        await deliver_job(message, message.from_user.id, "youtube_video", url, "video", selected_format['format_id'])
         await message.answer("Загрузка завершена ✅ Что дальше?",
                              reply_markup=post_download_keyboard())
         await state.set_state(UserStates.START)
@@ -889,77 +2851,174 @@ async def handle_quality_selection(message: types.Message, state: FSMContext):
         await message.answer("Неверный выбор ❌. Попробуйте снова.")
 
 
-async def download_video_with_quality(url, selected_format, user_id):
+async def download_video_with_quality(url, selected_format, user_id, workdir):
     ydl_opts = {
         'format': selected_format['format_id'],
-        'outtmpl': f'{user_id}_video.%(ext)s',
+        'outtmpl': os.path.join(workdir, 'video.%(ext)s'),
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        file_path = f"{user_id}_video.{selected_format['ext']}"
-        title = info.get('title', 'Untitled')
-        save_download(user_id, file_path, 'video')
-        return file_path, title
+    info = await ydl_download(url, ydl_opts, name="youtube_video")
+    file_path = downloaded_file_path(info, os.path.join(workdir, f"video.{info['ext']}"))
+    title = info.get('title', 'Untitled')
+    save_download(user_id, url, title, 'video')
+    return file_path, title
 
 
 async def get_video_metadata(url):
-    ydl_opts = {'quiet': True, 'skip_download': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = ydl.extract_info(url, download=False)
-            return {
-                "title": info.get("title", "Без названия"),
-                "views": info.get("view_count", "Нет данных"),
-                "likes": info.get("like_count", "Нет данных"),
-                "uploader": info.get("uploader", "Неизвестный")
-            }
-        except Exception as e:
-            logging.error(f"Ошибка извлечения метаданных: {e}")
-            return {"title": "Не удалось получить данные", "views": "-", "likes": "-", "uploader": "-"}
+    try:
+        info = await get_video_info(url)
+        return {
+            "title": info.get("title", "Без названия"),
+            "views": info.get("view_count", "Нет данных"),
+            "likes": info.get("like_count", "Нет данных"),
+            "uploader": info.get("uploader", "Неизвестный")
+        }
+    except Exception as e:
+        logging.error(f"Ошибка извлечения метаданных: {e}")
+        return {"title": "Не удалось получить данные", "views": "-", "likes": "-", "uploader": "-"}
 
 
 async def get_available_formats(url):
-    ydl_opts = {'listformats': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        formats = [f for f in info.get('formats', []) if f.get('acodec') != 'none' and f.get('vcodec') != 'none']
-        return [{'format_id': f['format_id'], 'resolution': f.get('resolution', 'audio'), 'ext': f['ext']} for f in
-                formats]
+    info = await get_video_info(url)
+    formats = [f for f in info.get('formats', []) if f.get('acodec') != 'none' and f.get('vcodec') != 'none']
+    limit = upload_limit()
+    result = []
+    for f in formats:
+        size = estimate_filesize(f, info.get('duration'))
+        result.append({'format_id': f['format_id'], 'resolution': f.get('resolution', 'audio'), 'ext': f['ext'],
+                       'filesize': size, 'fits': not size or size <= limit})
+    return result
+
+
+# --- ВЫБОР ФОРМАТА ПО РАЗМЕРУ ---
+def upload_limit():
+    """Максимальный размер файла, который бот может отправить в Telegram"""
+    return MAX_TELEGRAM_FILE_SIZE if BOT_API_URL else TELEGRAM_MAX_FILE_SIZE
+
+
+def estimate_filesize(fmt, duration=None):
+    """Размер формата в байтах: точный, примерный или по битрейту. None, если оценить нельзя"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = int(fmt['tbr'] * 1000 / 8 * duration)
+    return size
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.0f} МБ"
+
+
+def format_label(f):
+    """Текст кнопки качества. Форматы больше лимита помечаются ⚠️"""
+    label = f"{f['resolution']} - {f['ext']}"
+    if f.get('filesize'):
+        label += f" (~{format_size(f['filesize'])})"
+    if not f.get('fits', True):
+        label += " ⚠️"
+    return label
+
+
+def plan_format(info, limit=None):
+    """
+    Выбирает лучший формат со звуком и видео, который помещается в лимит загрузки
+    :return: Формат из info_dict или None, если ни один формат не помещается
+    """
+    limit = limit or upload_limit()
+    formats = info.get('formats') or [info]
+    candidates = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') != 'none'] or formats
+
+    # yt-dlp сортирует форматы от худшего к лучшему
+    fitting, unknown = [], []
+    for f in candidates:
+        size = estimate_filesize(f, info.get('duration'))
+        if size is None:
+            unknown.append(f)
+        elif size <= limit:
+            fitting.append(f)
+
+    # Форматы с известным размером надежнее: неизвестный берем, только если других нет
+    if fitting:
+        return fitting[-1]
+    return unknown[-1] if unknown else None
+
+
+def plan_audio_format(info):
+    """
+    Формат, который выберет 'bestaudio[acodec^=mp4a]' в download_audio
+    :return: Лучший AAC-поток без видео или None, если звук придется перекодировать в MP3
+    """
+    aac = [f for f in info.get('formats') or []
+           if (f.get('acodec') or '').startswith('mp4a') and f.get('vcodec') in (None, 'none')]
+    return aac[-1] if aac else None
+
 
+class FileTooLargeError(ValueError):
+    pass
 
-async def download_audio(url, user_id):
+
+def check_format_size(info, format_id, limit=None):
+    """Отказывает заранее, если выбранный формат точно не пройдет в Telegram"""
+    limit = limit or upload_limit()
+    fmt = next((f for f in info.get('formats') or [info] if f.get('format_id') == format_id), None)
+    size = estimate_filesize(fmt, info.get('duration')) if fmt else None
+    if size and size > limit:
+        raise FileTooLargeError(
+            f"Файл ~{format_size(size)} больше лимита Telegram ({format_size(limit)}). Выберите качество пониже")
+
+
+async def download_audio(url, user_id, workdir):
+    """
+    Скачивает аудио. Если есть AAC-поток, он отправляется как m4a без перекодирования
+    (копией или перепаковкой), иначе звук перекодируется в MP3 192 кбит/с
+    """
     ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}],
-        'outtmpl': f'{user_id}_audio.%(ext)s',
+        # Сначала AAC: Telegram принимает его как аудио без перекодирования
+        'format': 'bestaudio[acodec^=mp4a]/bestaudio/best',
+        'outtmpl': os.path.join(workdir, 'source.%(ext)s'),
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        file_path = f"{user_id}_audio.mp3"
-        title = info.get('title', 'Untitled')
-        save_download(user_id, file_path, 'audio')
-        return file_path, title
+    info = await get_video_info(url)
+    limit = upload_limit()
+    aac = plan_audio_format(info)
+    if aac:
+        # AAC уходит как есть: считаем по размеру самого потока
+        size = estimate_filesize(aac, info.get('duration'))
+        if size and size > limit:
+            raise FileTooLargeError(f"Аудио ~{format_size(size)} больше лимита Telegram ({format_size(limit)}) ❌")
+    elif info.get('duration') and info['duration'] * 192000 / 8 > limit:
+        # MP3 192 кбит/с: размер заранее известен по длительности
+        raise FileTooLargeError(f"Аудио длиннее, чем помещается в {format_size(limit)} ❌")
+    info = await ydl_download(url, ydl_opts, name="youtube_audio")
+    source = downloaded_file_path(info, os.path.join(workdir, f"source.{info['ext']}"))
+
+    if (info.get('acodec') or '').startswith('mp4a'):
+        if info['ext'] == 'm4a' and info.get('vcodec') in (None, 'none'):
+            file_path = source
+        else:
+            # AAC внутри другого контейнера или видео: копируем дорожку без перекодирования
+            file_path = os.path.join(workdir, "audio.m4a")
+            await postprocessor.run('-i', source, '-vn', '-c:a', 'copy', file_path)
+    else:
+        file_path = os.path.join(workdir, "audio.mp3")
+        await postprocessor.run('-i', source, '-vn', '-c:a', 'libmp3lame', '-b:a', '192k', file_path)
+
+    title = info.get('title', 'Untitled')
+    save_download(user_id, url, title, 'audio')
+    return file_path, title
 
 
-async def download_vk_content(url, user_id):
+async def download_vk_content(url, user_id, workdir):
     ydl_opts = {
         'format': 'best',
-        'outtmpl': f'{user_id}_vk.%(ext)s',
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Referer': 'https://vk.com/',
-        },
+        'outtmpl': os.path.join(workdir, 'vk.%(ext)s'),
+        'http_headers': VK_HTTP_HEADERS,
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = ydl.extract_info(url, download=True)
-            file_path = f"{user_id}_vk.{info['ext']}"
-            title = info.get("title", "VK Content")
-            return file_path, title
-        except Exception as e:
-            raise ValueError(f"Ошибка загрузки: {e}")
+    try:
+        info = await ydl_download(url, ydl_opts, name="vk_video")
+        file_path = downloaded_file_path(info, os.path.join(workdir, f"vk.{info['ext']}"))
+        title = info.get("title", "VK Content")
+        return file_path, title
+    except Exception as e:
+        raise ValueError(f"Ошибка загрузки: {e}")
 
 
 async def search_youtube_videos(query: str, max_results=5):
@@ -972,30 +3031,27 @@ async def search_youtube_videos(query: str, max_results=5):
     }
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.extract_info(
-                f'ytsearch{max_results}:{query}',
-                download=False
-            )
-            if not result or 'entries' not in result:
-                return []
-
-            videos = []
-            for entry in result['entries']:
-                if entry:
-                    videos.append({
-                        'title': entry.get('title', 'Без названия'),
-                        'url': entry.get('url'),
-                        'duration': entry.get('duration'),
-                        'view_count': entry.get('view_count')
-                    })
-            return videos[:max_results]
+        result = await extractor.run(_ydl_extract, ydl_opts, f'ytsearch{max_results}:{query}', False,
+                                     name="search")
+        if not result or 'entries' not in result:
+            return []
+
+        videos = []
+        for entry in result['entries']:
+            if entry:
+                videos.append({
+                    'title': entry.get('title', 'Без названия'),
+                    'url': entry.get('url'),
+                    'duration': entry.get('duration'),
+                    'view_count': entry.get('view_count')
+                })
+        return videos[:max_results]
     except Exception as e:
         logging.error(f"Search error: {str(e)}", exc_info=True)
         return []
 
 
-async def download_vk_history(url, user_id, quality='720'):
+async def download_vk_history(url, user_id, workdir, quality='720'):
     # Эта функция работает криво с токеном бота, для историй нужен User Token,
     # но пока оставлю как было в исходнике, предполагая что ACCESS_TOKEN есть в env
     if "story" not in url:
@@ -1007,10 +3063,11 @@ async def download_vk_history(url, user_id, quality='720'):
         url_api = "https://api.vk.com/method/stories.getById"
         # Нужен ACCESS_TOKEN в .env для историй
         data = {"access_token": os.getenv("ACCESS_TOKEN"), 'stories': story_id}
-        res = requests.post(url_api, params=params, data=data)
+        async with http_client.post(url_api, params=params, data=data) as res:
+            response = await res.json(content_type=None)
 
         available_qualities = {}
-        items = res.json().get('response', {}).get('items', [])
+        items = response.get('response', {}).get('items', [])
         if not items:
             raise ValueError("История не найдена или доступ закрыт")
 
@@ -1028,48 +3085,570 @@ async def download_vk_history(url, user_id, quality='720'):
                 # Берем лучшее что есть
                 selected_quality_url = list(available_qualities.values())[0]
 
-            res = requests.get(selected_quality_url)
-            file_path = f"{user_id}_vk_story.mp4"
-            with open(file_path, 'wb') as f:
-                f.write(res.content)
+            file_path = os.path.join(workdir, "vk_story.mp4")
+            await http_client.download(selected_quality_url, file_path, upload_limit())
 
             return file_path, available_qualities
         else:
             # Если это фото
             return None, None
 
+    except FileTooLargeError:
+        raise
     except Exception as e:
         logging.error(f"VK Story Error: {e}")
         return None, None
 
 
+# Отправка медиа с учетом кэша file_id
+async def deliver_media(message: types.Message, url: str, file_type: str, format_id: str, download, title=None,
+                        platform=None, remote=False):
+    """
+    Отправляет медиа по file_id из кэша, а при промахе скачивает и загружает файл
+    :param download: Фабрика корутины, которая скачивает файл в переданную папку задачи
+                     и возвращает (file_path, title)
+    :param title: Подпись вместо названия, которое вернул загрузчик
+    :param platform: Платформа для лимитов планировщика, по умолчанию определяется по ссылке
+    :param remote: Скачать и отправить файл силами воркера брокера (нужна текущая задача в jobs)
+    :return: True, если файл отправлен
+    """
+    # После раскрытия короткой ссылки все ключи ниже указывают на само видео
+    await url_router.resolve(url)
+    platform = platform or detect_link_type(url) or "other"
+    current_platform.set(platform)
+    cached = await get_cached_file(url, format_id, file_type)
+    metrics.cache("file_id", cached is not None)
+    if cached:
+        file_id, cached_title = cached
+        try:
+            await send_media(message, file_id, title or cached_title, file_type)
+            logging.info(f"Отправлено из кэша file_id: {url} [{format_id}]")
+            await set_job_file(current_job.get(), file_id)
+            return True
+        except Exception as e:
+            # file_id мог стать недействительным, качаем заново
+            logging.warning(f"Не удалось отправить по file_id, удаляю из кэша: {e}")
+            delete_cached_file(url, format_id, file_type)
+
+    # Одинаковые запросы, пришедшие одновременно, ждут одну загрузку и получают ее file_id
+    async def notify_queued(position):
+        await message.answer(f"⏳ Все загрузчики заняты. Ваша позиция в очереди: {position}")
+
+    job_id = current_job.get()
+
+    async def download_remote():
+        # Воркер сам отправляет файл в чат и сохраняет file_id в кэш, откуда его берут остальные ожидающие
+        state, error = await run_remote_job(job_id)
+        if state == "local":
+            return await download_local()
+        if state != "done":
+            logging.error(f"Воркер не выполнил задачу {job_id}: {error}")
+            return None, None
+        cached = await get_cached_file(url, format_id, file_type)
+        return cached or (None, None)
+
+    async def run_download(workdir):
+        set_job_state(job_id, "downloading")
+        return await download(workdir)
+
+    async def download_local():
+        async with job_workspace(message.chat.id) as workdir:
+            # Профиль обработки задает file_type: audio — m4a/mp3 из download_audio, video — видео как есть.
+            # 'best' и выбор аудио зависят от лимита загрузки, поэтому лимит тоже входит в профиль:
+            # файл, выбранный под локальный Bot API, не уйдет боту с лимитом облачного
+            profile = f"{file_type}@{upload_limit()}"
+            cached = await media_cache.get(url, format_id, profile, workdir)
+            store = None
+            if cached:
+                file_path, downloaded_title = cached
+                logging.info(f"Файл взят из кэша на диске: {url} [{format_id}]")
+            else:
+                file_path, downloaded_title = await scheduler.run(message.chat.id, platform,
+                                                                  lambda: run_download(workdir),
+                                                                  on_queued=notify_queued)
+                # sha256 большого файла считается параллельно с загрузкой в Telegram, а не перед ней
+                store = asyncio.ensure_future(media_cache.put(url, format_id, profile, file_path, downloaded_title))
+            set_job_state(job_id, "uploading")
+            sent_title = title or downloaded_title
+            try:
+                file_id = await send_file(message, file_path, sent_title, file_type,
+                                          cache_key=(url, format_id, file_type))
+                await set_job_file(job_id, file_id)
+            finally:
+                # Папка задачи удаляется только после того, как файл попал в кэш
+                if store is not None:
+                    await store
+            return file_id, sent_title
+
+    async def download_and_send():
+        if remote and job_id is not None:
+            return await download_remote()
+        return await download_local()
+
+    try:
+        (file_id, sent_title), shared = await inflight.do((canonical_url(url), format_id, file_type),
+                                                          download_and_send)
+    except FileTooLargeError as e:
+        await message.answer(str(e))
+        return False
+
+    metrics.cache("inflight", shared)
+    if not shared:
+        return file_id is not None
+    if file_id is None:
+        await message.answer("Не удалось скачать файл 😔. Попробуйте снова.")
+        return False
+    logging.info(f"Файл отправлен из общей загрузки: {url} [{format_id}]")
+    await send_media(message, file_id, title or sent_title, file_type)
+    await set_job_file(current_job.get(), file_id)
+    return True
+
+
+# --- ЗАДАЧИ ЗАГРУЗКИ ---
+def job_download(kind, url, user_id, format_id, params):
+    """
+    Фабрика загрузчика по типу задачи. Задача хранит только kind и параметры,
+    поэтому после перезапуска загрузчик собирается заново
+    :return: Функция, которая принимает папку задачи и возвращает (file_path, title)
+    """
+    if kind == "youtube_video":
+        return lambda workdir: download_video_with_quality(url, {'format_id': format_id}, user_id, workdir)
+    elif kind == "youtube_audio":
+        return lambda workdir: download_audio(url, user_id, workdir)
+    elif kind == "vk_video":
+        return lambda workdir: download_vk_content(url, user_id, workdir)
+    elif kind == "vk_story":
+        return lambda workdir: download_vk_history(url, user_id, workdir)
+    elif kind == "rutube":
+        return lambda workdir: download_rutube_video(url, user_id, workdir)
+    elif kind == "tiktok":
+        return lambda workdir: download_tiktok_video(url, user_id, workdir)
+    elif kind == "vk_music":
+        async def download(workdir):
+            # В сохраненной задаче только id трека: ссылка на mp3 к этому времени могла истечь
+            track_url = params.get('track_url')
+            if not track_url:
+                track_url = (await vk_helper.get_track_urls([params['track_id']])).get(params['track_id'])
+            if not track_url:
+                raise ValueError("Трек больше недоступен в VK 😔")
+            file_path = await vk_helper.download_track(track_url, os.path.join(workdir, "music.mp3"))
+            if not file_path:
+                raise ValueError("Ошибка при скачивании файла 😔")
+            return file_path, params['title']
+        return download
+    raise ValueError(f"Неизвестный тип задачи: {kind}")
+
+
+async def run_job(job_id, func):
+    """
+    Выполняет задачу, отмечая ее в jobs: done, если func вернула истину, иначе failed.
+    При отмене (остановка бота) состояние не меняется, и задача продолжится после запуска
+    """
+    token = current_job.set(job_id)
+    try:
+        result = await func()
+    except Exception as e:
+        set_job_state(job_id, "failed", str(e))
+        raise
+    finally:
+        current_job.reset(token)
+    set_job_state(job_id, "done" if result else "failed")
+    return result
+
+
+async def deliver_job(message: types.Message, user_id, kind, url, file_type, format_id, title=None, params=None,
+                      job_id=None, remote=None):
+    """
+    Записывает задачу в jobs (если job_id не передан) и доставляет файл через deliver_media
+    :param remote: Отдать загрузку воркерам брокера, по умолчанию по DOWNLOAD_BACKEND
+    :return: True, если файл отправлен
+    """
+    if job_id is None:
+        job_id = create_job(user_id, message.chat.id, kind, url, file_type, format_id, title, params)
+    if remote is None:
+        remote = DOWNLOAD_BACKEND == "broker"
+    download = job_download(kind, url, user_id, format_id, params or {})
+    platform = "VK_MUSIC" if kind == "vk_music" else None
+    return await run_job(job_id, lambda: deliver_media(message, url, file_type, format_id, download, title=title,
+                                                       platform=platform, remote=remote))
+
+
+async def deliver_tracks_album(message: types.Message, user_id, tracks, job_id, remote=None):
+    """
+    Скачивает страницу треков и отправляет ее альбомом через send_tracks_album, сам или силами воркера брокера
+    :param remote: Отдать загрузку воркерам брокера, по умолчанию по DOWNLOAD_BACKEND
+    :return: True, если альбом отправлен
+    """
+    if remote is None:
+        remote = DOWNLOAD_BACKEND == "broker"
+    if remote:
+        # Воркер сам отправляет альбом в чат: треки лежат в params задачи
+        state, error = await run_remote_job(job_id)
+        if state != "local":
+            if state != "done":
+                logging.error(f"Воркер не выполнил задачу {job_id}: {error}")
+            return state == "done"
+    return await send_tracks_album(message, await vk_helper.with_urls(tracks), user_id)
+
+
+def chat_message(chat_id):
+    """Сообщение-заглушка чата: его answer_* пишут в чат через bot, когда входящего апдейта нет"""
+    return types.Message(message_id=0, date=datetime.now(), chat=types.Chat(id=chat_id, type="private")).as_(bot)
+
+
+def job_label(job):
+    """Название задачи для сообщений пользователю"""
+    return job['title'] or job['params'].get('title') or job['url'] or "треки"
+
+
+# Задачи, продолжающиеся после перезапуска
+resumed_jobs = set()
+
+
+async def resume_jobs(worker=0, workers=1):
+    """
+    Продолжает задачи, которые не завершились до остановки бота
+    :param worker: Номер процесса-обработчика: он берет только задачи своих пользователей
+    :param workers: Количество процессов-обработчиков
+    """
+    for job in await get_pending_jobs():
+        if user_worker(job['chat_id'], workers) != worker:
+            continue
+        if job['file_id']:
+            # Файл уже отправлен, бот остановился до отметки done
+            set_job_state(job['id'], "done")
+            continue
+        message = chat_message(job['chat_id'])
+        if job['attempts'] >= JOB_MAX_ATTEMPTS:
+            set_job_state(job['id'], "failed", "Превышено число попыток")
+            with contextlib.suppress(Exception):
+                await message.answer(f"Не удалось скачать {job_label(job)} после {job['attempts']} попыток 😔")
+            continue
+
+        retry_job(job['id'])
+        task = asyncio.create_task(resume_job(job, message))
+        resumed_jobs.add(task)
+        task.add_done_callback(resumed_jobs.discard)
+    if resumed_jobs:
+        logging.info(f"🔄 Продолжаю незавершенные задачи: {len(resumed_jobs)}")
+
+
+async def resume_job(job, message: types.Message):
+    try:
+        await message.answer(f"🔄 Бот был перезапущен, продолжаю загрузку: {job_label(job)}")
+        if job['kind'] == "vk_music_page":
+            tracks = job['params']['tracks']
+            await run_job(job['id'], lambda: deliver_tracks_album(message, job['user_id'], tracks, job['id']))
+        else:
+            await deliver_job(message, job['user_id'], job['kind'], job['url'], job['file_type'], job['format_id'],
+                              title=job['title'], params=job['params'], job_id=job['id'])
+    except Exception as e:
+        logging.error(f"Ошибка продолжения задачи {job['id']}: {e}")
+
+
+# --- ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАГРУЗОК ---
+class SingleFlight:
+    """Одновременные вызовы с одинаковым ключом выполняются один раз, остальные ждут общий результат"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """
+        :param func: Фабрика корутины, которую выполняет первый вызов
+        :return: (результат, True если результат получен от чужого вызова)
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Помечаем исключение полученным, даже если никто больше не ждал
+                future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+inflight = SingleFlight()
+metrics.gauge("bot_inflight_downloads", lambda: len(inflight), "Уникальные загрузки в работе")
+
+
+async def send_media(message: types.Message, media, title: str, file_type: str):
+    """Отправляет файл или file_id и возвращает file_id, который присвоил Telegram"""
+    if file_type == "audio":
+        sent = await message.answer_audio(audio=media, caption=title, title=title)
+        return (sent.audio or sent.document).file_id
+    elif file_type == "video":
+        sent = await message.answer_video(video=media, caption=title)
+        return (sent.video or sent.animation or sent.document).file_id
+    raise ValueError("Неподдерживаемый тип файла ❌")
+
+
 # Функция отправки файла
-async def send_file(message: types.Message, file_path: str, title: str, file_type: str):
-    if not os.path.exists(file_path):
+async def send_file(message: types.Message, file_path: str, title: str, file_type: str, cache_key=None):
+    """
+    Загружает файл в Telegram. Файл лежит в папке задачи и удаляется вместе с ней
+    :param cache_key: (url, format_id, media_type) для сохранения file_id в кэш
+    :return: file_id загруженного файла или None при ошибке
+    """
+    if not file_path or not os.path.exists(file_path):
         await message.answer("Файл не найден 🗑️. Попробуйте снова.")
-        return
+        return None
+
+    if BOT_API_URL:
+        # Локальный сервер принимает file:// и читает файл сам, без копирования через HTTP
+        file = Path(file_path).resolve().as_uri()
+    else:
+        file = FSInputFile(file_path)
+
+    try:
+        with metrics.timer("upload"):
+            file_id = await send_media(message, file, title, file_type)
+        metrics.inc("bot_bytes_total", os.path.getsize(file_path), direction="upload",
+                    platform=current_platform.get())
+        if cache_key:
+            save_cached_file(*cache_key, file_id, title)
+        return file_id
+    except Exception as e:
+        await message.answer(f"Ошибка при отправке файла: {e}")
+        return None
 
-    file = FSInputFile(file_path)
 
+# --- ВОРКЕР ЗАГРУЗОК ---
+async def run_claimed_job(job):
+    """Выполняет задачу брокера в этом процессе: скачивает, отправляет в чат и отмечает результат в jobs"""
+    if job['file_id']:
+        # Предыдущий воркер отправил файл, но не успел отметить задачу
+        set_job_state(job['id'], "done")
+        return
+    message = chat_message(job['chat_id'])
     try:
-        if file_type == "audio":
-            await message.answer_audio(audio=file, caption=title, title=title)
-        elif file_type == "video":
-            await message.answer_video(video=file, caption=title)
+        if job['kind'] == "vk_music_page":
+            tracks = job['params']['tracks']
+            await run_job(job['id'], lambda: deliver_tracks_album(message, job['user_id'], tracks, job['id'],
+                                                                  remote=False))
         else:
-            raise ValueError("Неподдерживаемый тип файла ❌")
+            await deliver_job(message, job['user_id'], job['kind'], job['url'], job['file_type'], job['format_id'],
+                              title=job['title'], params=job['params'], job_id=job['id'], remote=False)
     except Exception as e:
-        await message.answer(f"Ошибка при отправке файла: {e}")
+        logging.error(f"Ошибка задачи {job['id']} в воркере: {e}")
+
+
+async def download_worker(max_jobs=BROKER_WORKER_JOBS):
+    """
+    Процесс без обработчиков Telegram: берет задачи из таблицы jobs, скачивает их и отправляет в чаты.
+    Таких процессов можно запустить сколько угодно, в том числе на других машинах с общей базой
+    :param max_jobs: Сколько задач воркер выполняет одновременно
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    await startup(resume=False)
+    running = {}
+    last_heartbeat = 0
+    logging.info(f"🛠 Воркер загрузок {worker} запущен, задач одновременно: {max_jobs}")
+    try:
+        while True:
+            if time.monotonic() - last_heartbeat > BROKER_LEASE / 3:
+                heartbeat_jobs(worker)
+                requeue_stale_jobs()
+                last_heartbeat = time.monotonic()
+
+            while len(running) < max_jobs:
+                claimed = [job for job in await claim_jobs(worker) if job['id'] not in running]
+                if not claimed:
+                    break
+                for job in claimed:
+                    task = asyncio.create_task(run_claimed_job(job))
+                    running[job['id']] = task
+                    task.add_done_callback(lambda _, job_id=job['id']: running.pop(job_id, None))
+            await asyncio.sleep(BROKER_POLL_INTERVAL)
+    finally:
+        for task in list(running.values()):
+            task.cancel()
+        release_jobs(worker)
+        await shutdown()
+
+
+# --- РЕЖИМ WEBHOOK ---
+def user_worker(user_id, workers):
+    """Номер процесса для пользователя: апдейты одного пользователя всегда идут в один процесс"""
+    return abs(int(user_id or 0)) % workers
+
+
+def update_user_id(data):
+    """id пользователя из апдейта Telegram (сырой JSON), 0 если его нет"""
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return 0
+
+
+async def startup(worker=0, workers=1, resume=True):
+    """
+    Общий запуск для polling, webhook, процессов-обработчиков и воркеров загрузок
+    :param resume: Продолжить незавершенные задачи (воркеры брокера этого не делают)
+    """
+    init_db()
+    media_cache.open()
+    if METRICS_PORT:
+        # У каждого процесса-обработчика свой порт метрик
+        port = METRICS_PORT + worker if workers == 1 else METRICS_PORT + worker + 1
+        await metrics.start_server(METRICS_HOST, port)
+    loop_watchdog.start()
+    if resume:
+        await resume_jobs(worker, workers)
+
+
+async def shutdown():
+    loop_watchdog.stop()
+    await metrics.close()
+    await db.close()
+    await media_cache.close()
+    await http_client.close()
+    postprocessor.close()
+    engine.shutdown()
+    extractor.shutdown()
+    await bot.session.close()
+
+
+async def feed_raw_update(data):
+    """Передает апдейт в диспетчер так же, как это делает polling"""
+    update = types.Update.model_validate(data, context={"bot": bot})
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logging.error(f"Ошибка обработки апдейта {data.get('update_id')}: {e}")
+
+
+async def webhook_worker_loop(worker, workers, queue):
+    """Процесс-обработчик: получает апдейты своих пользователей из очереди и обрабатывает их"""
+    await startup(worker, workers)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    logging.info(f"✅ Обработчик {worker + 1}/{workers} запущен")
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            task = asyncio.create_task(feed_raw_update(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await shutdown()
+
+
+def webhook_worker(worker, workers, queue):
+    asyncio.run(webhook_worker_loop(worker, workers, queue))
+
+
+async def serve_webhook(queues=None):
+    """
+    Принимает апдейты по webhook. С очередями раздает их процессам-обработчикам по id пользователя,
+    без очередей обрабатывает сам
+    :param queues: multiprocessing-очереди процессов-обработчиков
+    """
+    tasks = set()
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        data = await request.json()
+        if queues:
+            queues[user_worker(update_user_id(data), len(queues))].put(data)
+        else:
+            task = asyncio.create_task(feed_raw_update(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Telegram ждет быстрый ответ, обработка идет в фоне
+        return web.Response()
+
+    if not queues:
+        await startup()
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+        logging.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+                     f"обработчиков: {len(queues) if queues else 1}")
+        await asyncio.Event().wait()
     finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        await runner.cleanup()
+        if queues:
+            await bot.session.close()
+        else:
+            await shutdown()
+
+
+def run_webhook(workers):
+    queues, processes = [], []
+    if workers > 1:
+        # Таблицы создаются до запуска процессов, чтобы они не делали это одновременно
+        init_db()
+        queues = [multiprocessing.Queue() for _ in range(workers)]
+        processes = [multiprocessing.Process(target=webhook_worker, args=(idx, workers, queue),
+                                             name=f"bot-worker-{idx}", daemon=True)
+                     for idx, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(serve_webhook(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
 
 
 # Запуск бота
 async def main():
-    init_db()
-    await dp.start_polling(bot)
+    await startup()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Telegram-бот для скачивания видео и музыки")
+    parser.add_argument("--mode", choices=("polling", "webhook", "worker"), default=BOT_MODE,
+                        help="Получение апдейтов: long polling или webhook (по умолчанию BOT_MODE). "
+                             "worker — воркер загрузок для DOWNLOAD_BACKEND=broker")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS,
+                        help="Процессы-обработчики в режиме webhook (по умолчанию WEBHOOK_WORKERS)")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    if args.mode == "webhook":
+        run_webhook(args.workers)
+    elif args.mode == "worker":
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(download_worker())
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,539 @@
+"""
+Нагрузочный тест бота без Telegram, YouTube и VK.
+
+Поднимает локальный сервер, который изображает Bot API (отдает апдейты через getUpdates
+и принимает загрузки файлов), источник медиа и VK API. Бот загружается из MainBotAio1.4.py
+как есть и работает через dp.start_polling; подменяются только извлечение yt-dlp
+(_ydl_extract отдает синтетический info_dict со ссылками на локальный источник)
+и адрес VK API (VK_API_URL указывает на локальный сервер).
+
+Сценарии:
+    video — /start → ссылка YouTube → «Скачать видео» → выбор качества → sendVideo
+    music — /start → поиск VK → следующая страница → скачать трек → sendAudio
+
+Пример:
+    python loadtest.py --rate 5 --duration 30 --mix video=3,music=1
+    python loadtest.py --local-bot-api --media-size 60000000 --rate 1 --duration 5
+"""
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import yt_dlp
+from aiohttp import web
+
+BOT_FILE = Path(__file__).with_name("MainBotAio1.4.py")
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+# Сообщения бота, после которых сценарий считается неудачным
+FAILURE_MARKERS = ("Ошибка", "Не удалось", "Неверный выбор", "Неподдерживаемое")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--rate", type=float, default=2.0, help="Новых сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=20.0, help="Сколько секунд запускать новые сценарии")
+    parser.add_argument("--mix", default="video=1,music=1", help="Доли сценариев, например video=3,music=1")
+    parser.add_argument("--poisson", action="store_true", help="Пуассоновский поток вместо равномерного")
+    parser.add_argument("--videos", type=int, default=50, help="Сколько разных видео в ссылках")
+    parser.add_argument("--queries", type=int, default=20, help="Сколько разных поисковых запросов VK")
+    parser.add_argument("--media-size", type=int, default=2 * 1024 * 1024, help="Размер файлов источника, байт")
+    parser.add_argument("--extract-delay", type=float, default=0.3, help="Имитация времени извлечения yt-dlp, сек.")
+    parser.add_argument("--origin-delay", type=float, default=0.0, help="Задержка ответа источника медиа, сек.")
+    parser.add_argument("--think-time", type=float, default=0.3,
+                        help="Пауза пользователя между шагами, сек. Без нее ответ приходит раньше, "
+                             "чем обработчик сменит состояние FSM")
+    parser.add_argument("--step-timeout", type=float, default=60.0, help="Сколько ждать ответа бота на шаг, сек.")
+    parser.add_argument("--local-bot-api", action="store_true",
+                        help="Режим своего сервера telegram-bot-api: бот отправляет файлы по file:// с лимитом 2 ГБ")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot", default=str(BOT_FILE), help="Путь к файлу бота")
+    parser.add_argument("--json", help="Сохранить итоговый отчет в JSON-файл")
+    parser.add_argument("--verbose", action="store_true", help="Не приглушать логи бота")
+    return parser.parse_args()
+
+
+def percentile(values, q):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+# --- ЗАГЛУШКИ TELEGRAM, ИСТОЧНИКА МЕДИА И VK ---
+class FakeServices:
+    """
+    Один aiohttp-сервер на все заглушки:
+    /bot{token}/{method} — Bot API, /media/{name} — файлы, /method/audio.search и /method/audio.getById — VK
+    :param local: Изображать локальный telegram-bot-api: принимать файлы по file:// вместо multipart
+    """
+
+    def __init__(self, media_size, origin_delay=0.0, local=False):
+        self.payload = os.urandom(min(media_size, 1024 * 1024)) * (media_size // (1024 * 1024) or 1)
+        self.payload = self.payload[:media_size]
+        self.origin_delay = origin_delay
+        self.local = local
+        self.base_url = None
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self.local_bytes = 0
+        self.inboxes = defaultdict(asyncio.Queue)
+        self._updates = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self._bot_api)
+        app.router.add_get("/media/{name}", self._media)
+        app.router.add_post("/method/audio.search", self._vk_search)
+        app.router.add_post("/method/audio.getById", self._vk_get_by_id)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # Апдейты для бота
+    def push_update(self, **update):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_update.set()
+
+    def message_id(self):
+        return next(self._message_ids)
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), min(float(params.get("timeout") or 0), 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:100]
+
+    # Bot API
+    def _message(self, chat_id, **fields):
+        return {"message_id": self.message_id(), "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": int(chat_id), "type": "private"}, **fields}
+
+    async def _read_files(self, form):
+        """
+        Считает байты файлов запроса. Multipart-файлы читаются, а пути file:// проверяются на диске,
+        как это делает локальный telegram-bot-api
+        :return: Текст ошибки Bot API или None
+        """
+        uris = []
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                self.uploaded_bytes += len(value.file.read())
+            elif isinstance(value, str) and value.startswith("file://"):
+                uris.append(value)
+        if form.get("media"):
+            uris += [item["media"] for item in json.loads(form["media"]) if item["media"].startswith("file://")]
+
+        for uri in uris:
+            if not self.local:
+                return "Bad Request: wrong HTTP URL specified"
+            path = urllib.parse.unquote(urllib.parse.urlsplit(uri).path)
+            if not os.path.isfile(path):
+                self.calls["file_missing"] += 1
+                return f"Bad Request: file {path} not found"
+            self.calls["file_uri"] += 1
+            self.local_bytes += os.path.getsize(path)
+        return None
+
+    def _deliver(self, chat_id, method, message, reply_markup=None):
+        self.inboxes[int(chat_id)].put_nowait({"method": method, "message": message, "reply_markup": reply_markup})
+
+    async def _bot_api(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+        reply_markup = json.loads(form["reply_markup"]) if form.get("reply_markup") else None
+        chat_id = form.get("chat_id")
+
+        if method == "getUpdates":
+            result = await self._get_updates(form)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            fields = {"text": form.get("text", "")}
+            if reply_markup and "inline_keyboard" in reply_markup:
+                fields["reply_markup"] = reply_markup
+            result = self._message(chat_id, **fields)
+            if method == "editMessageText":
+                result["message_id"] = int(form["message_id"])
+            self._deliver(chat_id, method, result, reply_markup)
+        elif method in ("sendVideo", "sendAudio"):
+            error = await self._read_files(form)
+            if error:
+                return web.json_response({"ok": False, "error_code": 400, "description": error}, status=400)
+            file_id = f"file{next(self._file_ids)}"
+            if method == "sendVideo":
+                media = {"video": {"file_id": file_id, "file_unique_id": file_id,
+                                   "width": 640, "height": 360, "duration": 10}}
+            else:
+                media = {"audio": {"file_id": file_id, "file_unique_id": file_id, "duration": 10}}
+            result = self._message(chat_id, caption=form.get("caption", ""), **media)
+            self._deliver(chat_id, method, result)
+        elif method == "sendMediaGroup":
+            error = await self._read_files(form)
+            if error:
+                return web.json_response({"ok": False, "error_code": 400, "description": error}, status=400)
+            result = []
+            for _ in json.loads(form["media"]):
+                file_id = f"file{next(self._file_ids)}"
+                result.append(self._message(chat_id, audio={"file_id": file_id, "file_unique_id": file_id,
+                                                            "duration": 10}))
+            self._deliver(chat_id, method, result)
+        else:
+            # answerCallbackQuery, deleteMessage, deleteWebhook и прочее
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # Источник медиа
+    async def _media(self, request):
+        self.calls["media"] += 1
+        if self.origin_delay:
+            await asyncio.sleep(self.origin_delay)
+        return web.Response(body=self.payload, content_type="application/octet-stream")
+
+    # VK API
+    async def _vk_search(self, request):
+        self.calls["vk_search"] += 1
+        form = await request.post()
+        query = form.get("q", "")
+        count = int(form.get("count", 50))
+        offset = int(form.get("offset", 0))
+        slug = urllib.parse.quote(query.replace(" ", "_"))
+        items = [{"owner_id": 100, "id": offset + i, "artist": f"Artist {query}", "title": f"Track {offset + i}",
+                  "url": f"{self.base_url}/media/{slug}_{offset + i}.mp3", "duration": 180}
+                 for i in range(count)]
+        return web.json_response({"response": {"count": 1000, "items": items}})
+
+    async def _vk_get_by_id(self, request):
+        self.calls["vk_get_by_id"] += 1
+        form = await request.post()
+        items = []
+        for audio in form.get("audios", "").split(","):
+            owner_id, audio_id = audio.split("_")
+            items.append({"owner_id": int(owner_id), "id": int(audio_id), "artist": "Artist", "title": f"Track {audio_id}",
+                          "url": f"{self.base_url}/media/{owner_id}_{audio_id}.mp3", "duration": 180})
+        return web.json_response({"response": items})
+
+
+# --- ПОДМЕНА ВНЕШНИХ ВЫЗОВОВ В БОТЕ ---
+def load_bot(path, workdir, bot_api_url=""):
+    """
+    Загружает бота с базой, хранилищем FSM, папкой загрузок и кэшем файлов во временной папке
+    :param bot_api_url: Адрес заглушки, если бот должен работать как с локальным telegram-bot-api
+    """
+    os.environ.update({
+        "TOKEN": "123456:loadtest",
+        "BOT_API_URL": bot_api_url,
+        "DB_PATH": os.path.join(workdir, "telegram_bot.db"),
+        "FSM_DB_PATH": os.path.join(workdir, "fsm_storage.db"),
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "MEDIA_CACHE_DIR": os.path.join(workdir, "media_cache"),
+        "METRICS_PORT": os.getenv("METRICS_PORT", "0"),
+    })
+    spec = importlib.util.spec_from_file_location("bot", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["bot"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def patch_bot(m, services, args):
+    from aiogram.client.telegram import TelegramAPIServer
+
+    m.bot.session.api = TelegramAPIServer.from_base(services.base_url, is_local=services.local)
+    size = len(services.payload)
+
+    def fake_extract(ydl_opts, url, download=True):
+        """
+        Синтетический info_dict: форматы ведут на локальный источник. Как и настоящий extract_info,
+        отдает словарь после выбора формата по умолчанию (bestvideo*+bestaudio при наличии ffmpeg),
+        то есть с requested_formats и полями выбранного формата
+        """
+        time.sleep(args.extract_delay)
+        video_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get("v", ["x"])[0]
+        media = f"{services.base_url}/media/{video_id}"
+        raw = {
+            "id": video_id, "title": f"Load test {video_id}", "uploader": "loadtest", "view_count": 1,
+            "like_count": 1, "duration": 10, "extractor": "youtube", "extractor_key": "Youtube",
+            "webpage_url": url, "original_url": url,
+            "formats": [
+                {"format_id": "140", "url": f"{media}.m4a", "ext": "m4a", "protocol": "http",
+                 "vcodec": "none", "acodec": "mp4a.40.2", "filesize": size // 4},
+                {"format_id": "18", "url": f"{media}_360.mp4", "ext": "mp4", "protocol": "http",
+                 "vcodec": "avc1.42001E", "acodec": "mp4a.40.2", "width": 640, "height": 360,
+                 "resolution": "640x360", "filesize": size},
+                {"format_id": "22", "url": f"{media}_720.mp4", "ext": "mp4", "protocol": "http",
+                 "vcodec": "avc1.64001F", "acodec": "mp4a.40.2", "width": 1280, "height": 720,
+                 "resolution": "1280x720", "filesize": size},
+                # Видео без звука, как у YouTube: из-за него выбор по умолчанию склеивает 137+140
+                {"format_id": "137", "url": f"{media}_1080.mp4", "ext": "mp4", "protocol": "http",
+                 "vcodec": "avc1.640028", "acodec": "none", "width": 1920, "height": 1080,
+                 "resolution": "1920x1080", "filesize": size},
+            ],
+        }
+        with yt_dlp.YoutubeDL({"quiet": True, "format": "bestvideo*+bestaudio/best"}) as ydl:
+            return ydl.process_ie_result(raw, download=False)
+
+    original_process = m._ydl_process
+
+    def quiet_process(ydl_opts, info):
+        return original_process({**ydl_opts, "quiet": True, "noprogress": True}, info)
+
+    m._ydl_extract = fake_extract
+    m._ydl_process = quiet_process
+    # Поиск VK идет настоящим кодом бота, только в локальный VK API
+    m.VK_API_URL = f"{services.base_url}/method"
+    m.vk_helper.token = m.vk_helper.token or "loadtest"
+
+
+# --- ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ ---
+class FlowFailed(Exception):
+    pass
+
+
+class VirtualUser:
+    """Пишет боту от имени пользователя и ждет его ответов в своем почтовом ящике"""
+
+    def __init__(self, services, user_id, timeout):
+        self.services = services
+        self.user_id = user_id
+        self.timeout = timeout
+        self.user = {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+        self.inbox = services.inboxes[user_id]
+
+    def send(self, text):
+        self.services.push_update(message={
+            "message_id": self.services.message_id(), "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"}, "from": self.user, "text": text})
+
+    def press(self, message, data):
+        self.services.push_update(callback_query={
+            "id": str(self.services.message_id()), "from": self.user, "chat_instance": "loadtest",
+            "data": data, "message": message})
+
+    async def expect(self, predicate):
+        """Ждет ответ бота, для которого predicate истинен"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FlowFailed("таймаут")
+            try:
+                event = await asyncio.wait_for(self.inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                raise FlowFailed("таймаут")
+            text = event["message"].get("text", "") if isinstance(event["message"], dict) else ""
+            if any(marker in text for marker in FAILURE_MARKERS):
+                raise FlowFailed(text[:80])
+            if predicate(event, text):
+                return event
+
+
+def keyboard_labels(event):
+    markup = event.get("reply_markup") or {}
+    return [button["text"] if isinstance(button, dict) else button
+            for row in markup.get("keyboard", []) for button in row]
+
+
+async def video_flow(user, rng, args):
+    url = f"https://www.youtube.com/watch?v=lt{rng.randrange(args.videos)}"
+    user.send("/start")
+    yield "start", await user.expect(lambda e, t: t.startswith("Добро пожаловать"))
+    user.send("Отправить ссылку 🔗")
+    yield "menu", await user.expect(lambda e, t: t.startswith("Пожалуйста, отправьте ссылку"))
+    user.send(url)
+    yield "metadata", await user.expect(lambda e, t: "Скачать видео 🎥" in keyboard_labels(e))
+    user.send("Скачать видео 🎥")
+    event = await user.expect(lambda e, t: t.startswith("Выберите качество"))
+    yield "formats", event
+    labels = [label for label in keyboard_labels(event) if label != "Назад ◀️" and "⚠️" not in label]
+    if not labels:
+        # Без --local-bot-api лимит 50 МБ: при большом --media-size подходящих форматов нет
+        raise FlowFailed("все форматы больше лимита загрузки")
+    label = labels[0]
+    user.send(label)
+    yield "download", await user.expect(lambda e, t: e["method"] == "sendVideo")
+
+
+async def music_flow(user, rng, args):
+    user.send("/start")
+    yield "start", await user.expect(lambda e, t: t.startswith("Добро пожаловать"))
+    user.send("Поиск музыки VK 🎧")
+    yield "menu", await user.expect(lambda e, t: t.startswith("Введите название"))
+    user.send(f"artist {rng.randrange(args.queries)}")
+    event = await user.expect(lambda e, t: "inline_keyboard" in (e.get("reply_markup") or {}))
+    yield "search", event
+    user.press(event["message"], "music_page_1")
+    event = await user.expect(lambda e, t: e["method"] == "editMessageText")
+    yield "page", event
+    user.press(event["message"], f"music_dl_{rng.randrange(5, 10)}")
+    yield "download", await user.expect(lambda e, t: e["method"] == "sendAudio")
+
+
+FLOWS = {"video": video_flow, "music": music_flow}
+
+
+class Report:
+    def __init__(self):
+        self.steps = defaultdict(list)
+        self.flows = defaultdict(list)
+        self.failures = Counter()
+        self.started = time.monotonic()
+        self.finished = None
+
+    async def run_flow(self, name, user, rng, args):
+        """Время сценария — сумма времени ответов бота, без пауз пользователя"""
+        total = 0.0
+        step_started = time.monotonic()
+        try:
+            async for step, _ in FLOWS[name](user, rng, args):
+                latency = time.monotonic() - step_started
+                self.steps[f"{name}/{step}"].append(latency)
+                total += latency
+                await asyncio.sleep(args.think_time)
+                step_started = time.monotonic()
+            self.flows[name].append(total)
+        except FlowFailed as e:
+            self.failures[f"{name}: {e}"] += 1
+        except Exception as e:
+            self.failures[f"{name}: {type(e).__name__}: {e}"] += 1
+
+    def summary(self, services, m):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        completed = sum(len(times) for times in self.flows.values())
+
+        def stats(values):
+            return {"n": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90),
+                    "p99": percentile(values, 99), "max": max(values, default=0.0)}
+
+        return {
+            "elapsed": elapsed,
+            "completed": completed,
+            "failed": sum(self.failures.values()),
+            "throughput": completed / elapsed if elapsed else 0.0,
+            "flows": {name: stats(values) for name, values in sorted(self.flows.items())},
+            "steps": {name: stats(values) for name, values in sorted(self.steps.items())},
+            "failures": dict(self.failures),
+            "bot_api_calls": dict(services.calls),
+            "uploaded_bytes": services.uploaded_bytes,
+            "local_bytes": services.local_bytes,
+            "stages": stage_summary(m),
+        }
+
+
+def stage_summary(m):
+    """Количество и среднее время стадий бота из его гистограмм"""
+    result = {}
+    for (name, labels), (_, total, count) in m.metrics._histograms.items():
+        if name == "bot_stage_duration_seconds" and count:
+            labels = dict(labels)
+            result[f"{labels['stage']}/{labels['platform']}"] = {"n": count, "mean": total / count}
+    return dict(sorted(result.items()))
+
+
+def print_summary(summary):
+    print(f"\nСценариев завершено: {summary['completed']}, с ошибками: {summary['failed']}, "
+          f"время: {summary['elapsed']:.1f} с, пропускная способность: {summary['throughput']:.2f} сценариев/с")
+
+    header = f"{'':<22}{'n':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"
+    for title, rows in (("Сценарии целиком", summary["flows"]), ("Шаги сценариев", summary["steps"])):
+        print(f"\n{title}, сек.\n{header}")
+        for name, row in rows.items():
+            print(f"{name:<22}{row['n']:>6}{row['p50']:>9.3f}{row['p90']:>9.3f}{row['p99']:>9.3f}{row['max']:>9.3f}")
+
+    print(f"\nСтадии бота, сек.\n{'':<22}{'n':>6}{'mean':>9}")
+    for name, row in summary["stages"].items():
+        print(f"{name:<22}{row['n']:>6}{row['mean']:>9.3f}")
+
+    calls = ", ".join(f"{method} {count}" for method, count in sorted(summary["bot_api_calls"].items()))
+    print(f"\nВызовы заглушек: {calls}")
+    print(f"Загружено в Bot API: {summary['uploaded_bytes'] / 1024 / 1024:.1f} МБ")
+    if summary["local_bytes"]:
+        print(f"Передано по file://: {summary['local_bytes'] / 1024 / 1024:.1f} МБ")
+    for failure, count in summary["failures"].items():
+        print(f"Ошибка ×{count}: {failure}")
+
+
+async def main():
+    args = parse_args()
+    mix = {name: float(weight) for name, weight in (item.split("=") for item in args.mix.split(",") if item)}
+    unknown = set(mix) - set(FLOWS)
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    services = FakeServices(args.media_size, args.origin_delay, local=args.local_bot_api)
+    await services.start()
+
+    m = load_bot(args.bot, workdir, services.base_url if args.local_bot_api else "")
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    patch_bot(m, services, args)
+    m.init_db()
+    m.media_cache.open()
+
+    polling = asyncio.create_task(m.dp.start_polling(m.bot, handle_signals=False, close_bot_session=False))
+    report = Report()
+    rng = random.Random(args.seed)
+    names, weights = list(mix), list(mix.values())
+    tasks = []
+    try:
+        for user_id in itertools.count(10_000):
+            if time.monotonic() - report.started >= args.duration:
+                break
+            user = VirtualUser(services, user_id, args.step_timeout)
+            name = rng.choices(names, weights)[0]
+            tasks.append(asyncio.create_task(report.run_flow(name, user, random.Random(rng.random()), args)))
+            await asyncio.sleep(rng.expovariate(args.rate) if args.poisson else 1 / args.rate)
+        await asyncio.gather(*tasks)
+        report.finished = time.monotonic()
+    finally:
+        await m.dp.stop_polling()
+        await polling
+        await m.db.close()
+        await m.media_cache.close()
+        await m.http_client.close()
+        m.postprocessor.close()
+        m.engine.shutdown()
+        m.extractor.shutdown()
+        await m.bot.session.close()
+        await services.close()
+
+    summary = report.summary(services, m)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())